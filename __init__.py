@@ -4,6 +4,7 @@
 
 from trytond.pool import Pool
 from . import company
+from . import country
 from . import party
 from . import address
 from . import afip
@@ -15,15 +16,23 @@ def register():
     Pool.register(
         afip.PyAfipWsWrapper,
         afip.AFIPCountry,
+        afip.AFIPActivity,
+        afip.AFIPPadronCache,
+        afip.AFIPPadron,
         company.Company,
+        country.Country,
+        country.Subdivision,
         party.Configuration,
         party.AFIPVatCountry,
         party.Party,
         party.PartyIdentifier,
         party.GetAFIPDataStart,
+        party.CheckVatNumbersStart,
+        party.CheckVatNumbersResult,
         party.Cron,
         address.Address,
         module='party_ar', type_='model')
     Pool.register(
         party.GetAFIPData,
+        party.CheckVatNumbers,
         module='party_ar', type_='wizard')
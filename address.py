@@ -11,8 +11,6 @@ class Address(metaclass=PoolMeta):
 
     @staticmethod
     def default_country():
-        country = Pool().get('country.country').search([
-            ('code', '=', 'AR'),
-            ])
-        if country:
-            return country[0].id
+        Country = Pool().get('country.country')
+        country_id, _ = Country.get_afip_ids()
+        return country_id
@@ -2,45 +2,616 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 
-from pyafipws.wsaa import WSAA
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import islice
+import datetime
+import functools
 import hashlib
-import time
+import http.client
+import io
 import os
+import re
+import socket
 import sys
+import threading
+import time
 import traceback
+import urllib.error
+import zipfile
 import logging
 
-from trytond.model import Model, ModelView, ModelSQL, fields
+from trytond.config import config
+from trytond.model import Index, Model, ModelView, ModelSQL, Unique, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, is_full_text, lstrip_wildcard
 from trytond.i18n import gettext
-from .exceptions import PyAfipWsError
+from .exceptions import PyAfipWsError, AFIPUnavailable
 
 logger = logging.getLogger(__name__)
 
 
+class Padron(object):
+    '''
+    Answer of the AFIP padron detached from the web service client.
+
+    It has the attributes of WSSrPadronA5 used by party_ar so it can be
+    stored and used in place of the client.
+    '''
+    __slots__ = ('tipo_persona', 'data', 'monotributo', 'impuestos',
+        'actividades', 'domicilios', 'errores')
+
+    def __init__(self, tipo_persona='', data=None, monotributo='N',
+            impuestos=None, actividades=None, domicilios=None, errores=None):
+        self.tipo_persona = tipo_persona
+        self.data = data or {}
+        self.monotributo = monotributo
+        self.impuestos = list(impuestos or [])
+        self.actividades = list(actividades or [])
+        self.domicilios = list(domicilios or [])
+        self.errores = list(errores or [])
+
+    @classmethod
+    def from_ws(cls, ws):
+        return cls(**{k: getattr(ws, k, None) for k in cls.__slots__})
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{k: values.get(k) for k in cls.__slots__})
+
+    @classmethod
+    def from_persona(cls, persona):
+        '''
+        Create from a persona of the padron A5 (getPersona or getPersonaList)
+
+        The data is structured like WSSrPadronA5.Consultar does.
+        '''
+        data = dict(persona.get('datosGenerales') or {})
+        domicilio = data.get('domicilioFiscal')
+        regimen_general = persona.get('datosRegimenGeneral') or {}
+        monotributo = persona.get('datosMonotributo') or {}
+        data.update(regimen_general)
+        data.update(monotributo)
+
+        impuestos = (as_list(regimen_general.get('impuesto'))
+            + as_list(monotributo.get('impuesto')))
+        actividades = list(as_list(regimen_general.get('actividad')))
+        if monotributo.get('actividadMonotributista'):
+            actividades.append(monotributo['actividadMonotributista'])
+        actividades.sort(
+            key=lambda a: (a.get('orden') is None, a.get('orden') or 0))
+
+        errores = []
+        for key in ['errorConstancia', 'errorRegimenGeneral',
+                'errorMonotributo']:
+            if persona.get(key):
+                errores.extend({'error': str(e)}
+                    for e in as_list(persona[key].get('error')))
+        return cls(
+            tipo_persona=data.get('tipoPersona', ''),
+            data=data if persona.get('datosGenerales') else {},
+            monotributo='S' if monotributo.get('categoriaMonotributo')
+            else 'N',
+            impuestos=[i['idImpuesto'] for i in impuestos
+                if i.get('idImpuesto') is not None],
+            actividades=[a['idActividad'] for a in actividades
+                if a.get('idActividad') is not None],
+            domicilios=[domicilio] if domicilio else [],
+            errores=errores)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def as_list(value):
+    'Return the value of a SOAP sequence as a list'
+    if value is None:
+        return []
+    elif isinstance(value, list):
+        return value
+    return [value]
+
+
+def ticket_expiration(ta):
+    'Return the expirationTime of the access ticket as an aware datetime'
+    match = re.search(r'<expirationTime>([^<]+)</expirationTime>', ta or '')
+    if not match:
+        return None
+    try:
+        expiration = datetime.datetime.fromisoformat(match.group(1).strip())
+    except ValueError:
+        return None
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+    return expiration
+
+
+@functools.lru_cache(maxsize=32)
+def ticket_fingerprint(service, crt, key):
+    'Return the digest identifying the access ticket of the credentials'
+    return hashlib.md5((service + crt + key).encode('utf8')).hexdigest()
+
+
+class ClientPool(object):
+    '''
+    Pool of connected web service clients by key.
+
+    A client is used by a single thread between its checkout and checkin.
+    The clients that raised an exception are not reused.
+    '''
+
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self._idle = defaultdict(list)
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self, key, connect):
+        with self._lock:
+            generation = self._generations[key]
+            idle = self._idle.get(key)
+            ws = idle.pop() if idle else None
+        if ws is None:
+            ws = connect()
+        yield ws
+        with self._lock:
+            if (self._generations[key] == generation
+                    and len(self._idle[key]) < self.max_idle):
+                self._idle[key].append(ws)
+
+    def invalidate(self, match=None):
+        'Drop the clients whose key matches (all by default)'
+        with self._lock:
+            for key in list(self._generations):
+                if match is None or match(key):
+                    self._generations[key] += 1
+                    self._idle.pop(key, None)
+
+
+# HTTP status answered when AFIP throttles or its gateways time out
+TRANSIENT_STATUS = {408, 429, 502, 503, 504}
+# SOAP fault codes answered when AFIP throttles
+TRANSIENT_FAULTS = set(
+    config.get('party_ar', 'afip_transient_faults', default='').split())
+
+
+def http_status(exception):
+    'Return the HTTP status of the exception of urllib, httplib2 or httpx'
+    response = getattr(exception, 'response', None)
+    for status in [
+            getattr(exception, 'code', None),
+            getattr(response, 'status_code', None),
+            getattr(response, 'status', None),
+            ]:
+        if isinstance(status, int):
+            return status
+
+
+def fault_code(exception):
+    'Return the SOAP fault code of the exception without namespace'
+    code = getattr(exception, 'faultcode', None)
+    if code is None:
+        code = getattr(exception, 'code', None)
+    if isinstance(code, str):
+        return code.rsplit(':', 1)[-1]
+
+
+def is_transient_error(exception):
+    'Test if the exception is a throttling or transport failure'
+    if isinstance(exception, AFIPUnavailable):
+        return False
+    elif isinstance(exception, (
+                socket.timeout, TimeoutError, ConnectionError,
+                http.client.HTTPException)):
+        return True
+    elif isinstance(exception, urllib.error.URLError) and isinstance(
+            exception.reason, OSError):
+        return True
+    status = http_status(exception)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    return fault_code(exception) in TRANSIENT_FAULTS
+
+
+class RateLimiter(object):
+    '''
+    Token bucket shared by the calls to AFIP.
+
+    The rate grows additively while the calls answer under target_latency
+    and it is halved on throttling or transport failures.
+    '''
+
+    def __init__(self, rate, min_rate, max_rate, target_latency,
+            increase=0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.increase = increase
+        self.tokens = 1.
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        'Take a token or return the time to wait for one'
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(max(self.rate, 1.),
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            delay = self._take()
+            if not delay:
+                return
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        import asyncio
+        while True:
+            delay = self._take()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    def success(self, latency):
+        with self._lock:
+            if latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failure(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+
+# calls per second to AFIP of the process
+rate_limiter = RateLimiter(
+    rate=config.getfloat('party_ar', 'afip_rate', default=5),
+    min_rate=config.getfloat('party_ar', 'afip_min_rate', default=0.5),
+    max_rate=config.getfloat('party_ar', 'afip_max_rate', default=50),
+    target_latency=config.getfloat(
+        'party_ar', 'afip_target_latency', default=2))
+
+
+class CircuitBreaker(object):
+    '''
+    Fail fast while AFIP is down.
+
+    After threshold consecutive transport failures the circuit opens and
+    the calls fail immediately during cooldown seconds. Then a single probe
+    call is let through: its success closes the circuit and its failure
+    opens it again.
+    '''
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def before(self):
+        'Raise AFIPUnavailable if the call must not be done'
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            elif (self.state == self.OPEN
+                    and time.monotonic() >= self.opened + self.cooldown):
+                self.state = self.HALF_OPEN
+                return
+            raise AFIPUnavailable(
+                'AFIP is unavailable after %s consecutive failures.'
+                % self.failures)
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.threshold):
+                if self.state != self.OPEN:
+                    logger.warning('AFIP circuit opened after %s failures.',
+                        self.failures)
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+
+circuit_breaker = CircuitBreaker(
+    threshold=config.getint('party_ar', 'afip_breaker_threshold', default=5),
+    cooldown=config.getfloat('party_ar', 'afip_breaker_cooldown', default=60))
+
+
+@contextmanager
+def afip_call():
+    '''
+    Guard a call to AFIP
+
+    The call is rate limited and fails fast while the circuit is open.
+    Its outcome adapts the rate and the state of the circuit.
+    '''
+    circuit_breaker.before()
+    rate_limiter.acquire()
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        if is_transient_error(e):
+            rate_limiter.failure()
+            circuit_breaker.failure()
+        else:
+            rate_limiter.success(time.monotonic() - start)
+            circuit_breaker.success()
+        raise
+    rate_limiter.success(time.monotonic() - start)
+    circuit_breaker.success()
+
+
+# maximum number of personas by getPersonaList request
+PADRON_LIST_LIMIT = 250
+
+# padron clients of the process by (database, company, mode)
+padron_clients = ClientPool()
+
+
+@contextmanager
+def padron_client(credentials):
+    '''
+    Checkout a connected WSSrPadronA5 client for the credentials
+
+    The client is returned to the pool of the process when the block ends
+    without exception. It does not use the transaction.
+    '''
+    def connect():
+        # pyafipws is imported on first use to keep the pool init fast
+        from pyafipws.ws_sr_padron import WSSrPadronA5
+        ws = WSSrPadronA5()
+        ws.LanzarExcepciones = True
+        ws.Conectar(wsdl=credentials['wsdl'], cache=credentials['cache'],
+            cacert=True)
+        return ws
+
+    key = (
+        credentials['database'], credentials['company'], credentials['mode'])
+    with padron_clients.client(key, connect) as ws:
+        # parsing the ticket is only needed when it has been renewed
+        if getattr(ws, 'party_ar_ticket', None) != credentials['ta']:
+            ws.SetTicketAcceso(credentials['ta'])
+            ws.party_ar_ticket = credentials['ta']
+        ws.Cuit = credentials['cuit']
+        yield ws
+
+
+def add_personas(personas, vat_numbers, padrons, errors):
+    'Fill padrons and errors by VAT number from the personas of a batch'
+    for persona in personas:
+        if set(persona) == {'persona'}:
+            persona = persona['persona']
+        padron = Padron.from_persona(persona)
+        vat_number = padron.data.get('idPersona') or (
+            persona.get('errorConstancia') or {}).get('idPersona')
+        if vat_number is None:
+            continue
+        vat_number = str(vat_number)
+        if padron.data:
+            padrons[vat_number] = padron
+        else:
+            errors[vat_number] = ''.join(e['error'] for e in padron.errores)
+    for vat_number in vat_numbers:
+        if vat_number not in padrons:
+            errors.setdefault(vat_number, 'Not found in the padron')
+
+
+def query_padron_list(credentials, vat_numbers):
+    '''
+    Query the AFIP padron for many VAT numbers with getPersonaList
+
+    The VAT numbers are sent by batches of PADRON_LIST_LIMIT. Return a
+    dictionary of Padron and a dictionary of error messages by VAT number.
+    It does not use the transaction.
+    '''
+    padrons, errors = {}, {}
+    vat_numbers = list(vat_numbers)
+    for i in range(0, len(vat_numbers), PADRON_LIST_LIMIT):
+        batch = vat_numbers[i:i + PADRON_LIST_LIMIT]
+        with afip_call(), padron_client(credentials) as ws:
+            result = ws.client.getPersonaList_v2(
+                sign=ws.Sign, token=ws.Token, cuitRepresentada=ws.Cuit,
+                idPersona=[int(v) for v in batch])
+        personas = as_list(
+            (result.get('personaListReturn') or {}).get('persona'))
+        add_personas(personas, batch, padrons, errors)
+    return padrons, errors
+
+
+# Fixed-width records of the contributor file published by AFIP
+# (the same layout as pyafipws.padron)
+PADRON_FILE_FORMAT = [
+    ('cuit', 11),
+    ('denominacion', 30),
+    ('imp_ganancias', 2),
+    ('imp_iva', 2),
+    ('monotributo', 2),
+    ('integrante_soc', 1),
+    ('empleador', 1),
+    ('actividad_monotributo', 2),
+    ]
+PADRON_FILE_ENCODING = 'latin-1'
+# flags of the file converted into the impuestos of the web service
+PADRON_FILE_IVA = {'AC': 30, 'EX': 32, 'NA': 34}
+PADRON_FILE_GANANCIAS = {'AC': 10, 'EX': 12}
+# impuestos of the conditions computed by party.party get_padron_conditions
+IVA_IMPUESTOS = {
+    'responsable_inscripto': 30,
+    'exento': 32,
+    'no_alcanzado': 34,
+    }
+GANANCIAS_IMPUESTOS = {'in': 10, 'ex': 12}
+
+
+ACTIVITIES_PATH = os.path.join(
+    os.path.dirname(__file__), 'doc', 'ACTIVIDADES_ECONOMICAS_F883.txt')
+# rows by INSERT, it keeps the parameters below the limit of SQLite
+ACTIVITIES_BATCH = 150
+
+
+def activity_code(value):
+    'Return the code of the activity id answered by AFIP'
+    return str(value).rjust(6, '0')
+
+
+def read_activities(path=ACTIVITIES_PATH):
+    'Yield the code, name and description of the activities of the F883 file'
+    with open(path, encoding='utf-8', newline='') as lines:
+        next(lines, None)
+        for line in lines:
+            values = line.rstrip('\r\n').split(';')
+            if len(values) >= 3 and values[0].strip():
+                yield (values[0].strip(), values[1].strip(),
+                    values[2].strip() or None)
+
+
+def read_padron_file(path):
+    '''
+    Yield the records of the zipped contributor file as dictionaries
+
+    The member is decompressed and parsed line by line so the file is never
+    loaded in memory.
+    '''
+    with zipfile.ZipFile(path) as archive:
+        member = next(i for i in archive.infolist() if not i.is_dir())
+        with archive.open(member) as binary, io.TextIOWrapper(binary,
+                encoding=PADRON_FILE_ENCODING, newline='') as lines:
+            for line in lines:
+                record, start = {}, 0
+                for name, width in PADRON_FILE_FORMAT:
+                    record[name] = line[start:start + width].strip()
+                    start += width
+                if record['cuit']:
+                    yield record
+
+
+def padron_file_impuestos(record):
+    'Return the impuestos and monotributo of the contributor file record'
+    impuestos = []
+    if record['imp_iva'] in PADRON_FILE_IVA:
+        impuestos.append(PADRON_FILE_IVA[record['imp_iva']])
+    if record['imp_ganancias'] in PADRON_FILE_GANANCIAS:
+        impuestos.append(PADRON_FILE_GANANCIAS[record['imp_ganancias']])
+    monotributo = 'N' if record['monotributo'] in {'', 'NI'} else 'S'
+    return impuestos, monotributo
+
+
 class PyAfipWsWrapper(Model):
     'PyAfipWsWrapper'
     __name__ = 'afip.wrapper'
 
+    # access tickets of the process by (service, fingerprint, wsdl)
+    _tickets = {}
+    _tickets_lock = threading.Lock()
+    # renew the ticket a little before AFIP expires it
+    TICKET_MARGIN = datetime.timedelta(minutes=10)
+    # delay before a failed renewal is tried again
+    TICKET_RETRY = datetime.timedelta(minutes=1)
+
     @classmethod
     def authenticate(cls, service, crt, key, wsdl=None, proxy=None,
             wrapper=None, cacert=None, cache=None):
         "Método unificado para obtener el ticket de acceso (cacheado)"
+        ticket_key = (service, ticket_fingerprint(service, crt, key), wsdl)
+        ta = cls._get_ticket(ticket_key)
+        if ta:
+            return ta
+        # sólo un thread por proceso solicita el ticket a WSAA
+        with cls._tickets_lock:
+            ta = cls._get_ticket(ticket_key)
+            if not ta:
+                try:
+                    ticket = cls._authenticate(service, crt, key,
+                        ticket_key[1], wsdl=wsdl, proxy=proxy,
+                        wrapper=wrapper, cacert=cacert, cache=cache)
+                except PyAfipWsError as e:
+                    # WSAA no entrega un nuevo TA mientras el actual es
+                    # válido, se sigue usando hasta que venza
+                    ticket = cls._tickets.get(ticket_key)
+                    now = datetime.datetime.now(datetime.timezone.utc)
+                    if not ticket or ticket[1] <= now:
+                        raise
+                    logger.warning('Could not renew the access ticket of '
+                        '"%s", using the current one: "%s".', service, e)
+                    ticket = cls._retry_ticket(*ticket[:2])
+                cls._tickets[ticket_key] = ticket
+                ta = ticket[0]
+        return ta
+
+    @classmethod
+    def _get_ticket(cls, ticket_key):
+        ticket = cls._tickets.get(ticket_key)
+        if ticket:
+            ta, expiration, renewal = ticket
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if now < renewal and now < expiration:
+                return ta
+
+    @classmethod
+    def _new_ticket(cls, ta, expiration):
+        'Return the ticket of the process renewed before the margin'
+        return ta, expiration, expiration - cls.TICKET_MARGIN
+
+    @classmethod
+    def _retry_ticket(cls, ta, expiration):
+        'Return the ticket of the process after a failed renewal'
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return ta, expiration, min(now + cls.TICKET_RETRY, expiration)
+
+    @classmethod
+    def _authenticate(cls, service, crt, key, fingerprint, wsdl=None,
+            proxy=None, wrapper=None, cacert=None, cache=None):
+        "Obtener el ticket de acceso del archivo en cache o de WSAA"
+        from pyafipws.wsaa import WSAA
         DEFAULT_TTL = 60 * 60 * 5   # five hours
 
         wsaa = WSAA()
         wsaa.LanzarExcepciones = True
         try:
             # creo el nombre para el archivo del TA (según credenciales y ws)
-            ta_src = (service + crt + key).encode("utf8")
-            fn = "TA-%s.xml" % hashlib.md5(ta_src).hexdigest()
+            fn = "TA-%s.xml" % fingerprint
             if cache:
                 fn = os.path.join(cache, fn)
             else:
                 fn = os.path.join(wsaa.InstallDir, "cache", fn)
 
             # leer el ticket de acceso (si fue previamente solicitado)
-            if not os.path.exists(fn) or os.path.getsize(fn) == 0 or \
-               os.path.getmtime(fn) + (DEFAULT_TTL) < time.time():
+            ta, expiration = None, None
+            current = None
+            if os.path.exists(fn) and os.path.getsize(fn) > 0:
+                logger.debug("Leyendo TA de %s...", fn)
+                with open(fn, 'r') as f:
+                    ta = f.read()
+                expiration = ticket_expiration(ta)
+                if expiration is None:
+                    expiration = datetime.datetime.fromtimestamp(
+                        os.path.getmtime(fn) + DEFAULT_TTL,
+                        datetime.timezone.utc)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if ta and now < expiration:
+                current = ta, expiration
+            if not ta or expiration <= now + cls.TICKET_MARGIN:
                 # ticket de acceso (TA) vencido, crear un nuevo req. (TRA)
                 logger.debug("Creando TRA...")
                 tra = wsaa.CreateTRA(service=service, ttl=DEFAULT_TTL)
@@ -48,38 +619,38 @@ class PyAfipWsWrapper(Model):
                 logger.debug("Frimando TRA...")
                 cms = wsaa.SignTRA(tra, crt, key)
                 # concectar con el servicio web:
-                logger.debug("Conectando a WSAA...")
-                ok = wsaa.Conectar(cache, wsdl, proxy, wrapper, cacert)
-                if not ok or wsaa.Excepcion:
-                    raise RuntimeError("Fallo la conexión: %s" %
-                        wsaa.Excepcion)
-                # llamar al método remoto para solicitar el TA
-                logger.debug("Llamando WSAA...")
-                ta = wsaa.LoginCMS(cms)
+                with afip_call():
+                    logger.debug("Conectando a WSAA...")
+                    ok = wsaa.Conectar(cache, wsdl, proxy, wrapper, cacert)
+                    if not ok or wsaa.Excepcion:
+                        raise RuntimeError("Fallo la conexión: %s" %
+                            wsaa.Excepcion)
+                    # llamar al método remoto para solicitar el TA
+                    logger.debug("Llamando WSAA...")
+                    ta = wsaa.LoginCMS(cms)
                 if not ta:
                     raise RuntimeError("Ticket de acceso vacio: %s" %
                         WSAA.Excepcion)
+                expiration = ticket_expiration(ta)
+                if expiration is None:
+                    expiration = now + datetime.timedelta(seconds=DEFAULT_TTL)
                 # grabar el ticket de acceso para poder reutilizarlo luego
                 logger.debug("Grabando TA en %s...", fn)
                 try:
-                    f = open(fn, 'w')
-                    f.write(ta)
-                    f.close()
-                except IOError as e:
+                    with open(fn, 'w') as f:
+                        f.write(ta)
+                except IOError:
                     wsaa.Excepcion = (
                         "Imposible grabar ticket de accesso: %s" % fn)
-            else:
-                # leer el ticket de acceso del archivo en cache
-                logger.debug("Leyendo TA de %s...", fn)
-                f = open(fn, 'r')
-                ta = f.read()
-                f.close()
-            # analizar el ticket de acceso y extraer los datos relevantes
-            wsaa.AnalizarXml(xml=ta)
-            wsaa.Token = wsaa.ObtenerTagXml("token")
-            wsaa.Sign = wsaa.ObtenerTagXml("sign")
-        except Exception:
-            ta = ""
+        except Exception as e:
+            if current and datetime.datetime.now(
+                    datetime.timezone.utc) < current[1]:
+                # WSAA no entrega un nuevo TA mientras el actual es válido
+                logger.warning('Could not renew the access ticket of '
+                    '"%s", using the current one: "%s".', service, e)
+                return cls._retry_ticket(*current)
+            if isinstance(e, AFIPUnavailable):
+                raise
             if wsaa.Excepcion:
                 # get the exception already parsed by the helper
                 err_msg = wsaa.Excepcion
@@ -89,7 +660,7 @@ class PyAfipWsWrapper(Model):
                     sys.exc_info()[0], sys.exc_info()[1])[0]
             raise PyAfipWsError(gettext('party_ar.msg_pyafipws_error',
                     message=str(err_msg)))
-        return ta
+        return cls._new_ticket(ta, expiration)
 
 
 class AFIPCountry(ModelSQL, ModelView):
@@ -98,3 +669,424 @@ class AFIPCountry(ModelSQL, ModelView):
 
     code = fields.Char('Code')
     name = fields.Char('Name')
+
+
+def activity_code_clause(clause):
+    '''
+    Return the clause on an activity code using like instead of ilike
+
+    The codes are only digits so both match the same but only like can use the
+    prefix index of the code.
+    '''
+    name, operator, operand, *extra = clause
+    if operator in {'ilike', 'not ilike'}:
+        operator = operator.replace('ilike', 'like')
+    return (name, operator, operand, *extra)
+
+
+class AFIPActivity(ModelSQL, ModelView):
+    'AFIP Activity'
+    __name__ = 'afip.activity'
+
+    code = fields.Char('Code', required=True)
+    name = fields.Char('Name', required=True)
+    description = fields.Text('Description')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('code_uniq', Unique(t, t.code), 'party_ar.msg_activity_unique'),
+            ]
+        cls._sql_indexes.update({
+                Index(t, (t.code, Index.Similarity(begin=True))),
+                Index(t, (Index.Unaccent(t.description), Index.Similarity())),
+                })
+        cls._order.insert(0, ('code', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        cls.load_activities()
+
+    @classmethod
+    def load_activities(cls, path=ACTIVITIES_PATH):
+        '''
+        Insert the activities of the F883 file that do not exist and update
+        the labels that changed
+
+        The rows are inserted with multi-row INSERT statements instead of the
+        ORM because it runs on each update of the module.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+                table.code, table.name, table.description))
+        labels = {c: (n, d) for c, n, d in cursor}
+        now = datetime.datetime.now()
+        values, updated = [], False
+        for code, name, description in read_activities(path):
+            if code not in labels:
+                values.append(
+                    [code, name, description, transaction.user, now])
+            elif labels[code] != (name, description):
+                cursor.execute(*table.update(
+                        [table.name, table.description,
+                            table.write_uid, table.write_date],
+                        [name, description, transaction.user, now],
+                        where=table.code == code))
+                updated = True
+        if updated:
+            transaction.counter += 1
+            for cache in transaction.cache.values():
+                cache.pop(cls.__name__, None)
+        for sub_values in grouped_slice(values, ACTIVITIES_BATCH):
+            cursor.execute(*table.insert(
+                    [table.code, table.name, table.description,
+                        table.create_uid, table.create_date],
+                    list(sub_values)))
+
+    @classmethod
+    def get_activities(cls, codes):
+        'Return a dictionary of the activity ids by code'
+        activities = {}
+        for sub_codes in grouped_slice(set(codes)):
+            activities.update((a.code, a.id) for a in cls.search([
+                        ('code', 'in', list(sub_codes)),
+                        ]))
+        return activities
+
+    def get_rec_name(self, name):
+        return '%s - %s' % (self.code, self.name)
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        _, operator, operand, *extra = clause
+        if operator.startswith('!') or operator.startswith('not '):
+            bool_op = 'AND'
+        else:
+            bool_op = 'OR'
+        code_value = operand
+        if operator.endswith('like') and is_full_text(operand):
+            code_value = lstrip_wildcard(operand)
+        return [bool_op,
+            activity_code_clause(('code', operator, code_value, *extra)),
+            ('name', operator, operand, *extra),
+            ('description', operator, operand, *extra),
+            ]
+
+
+class AFIPPadronCache(ModelSQL):
+    'AFIP Padron Cache'
+    __name__ = 'afip.padron.cache'
+
+    vat_number = fields.Char('VAT Number', required=True)
+    mode = fields.Selection([
+        ('homologacion', 'Homologación'),
+        ('produccion', 'Producción'),
+        ], 'Mode', required=True)
+    response = fields.Dict(None, 'Response')
+    fetch_date = fields.DateTime('Fetch Date', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('vat_number_mode_uniq', Unique(t, t.vat_number, t.mode),
+                'party_ar.msg_padron_cache_unique'),
+            ]
+
+    @classmethod
+    def get_ttl(cls):
+        pool = Pool()
+        Configuration = pool.get('party.configuration')
+        return Configuration(1).padron_cache_ttl or datetime.timedelta()
+
+    @classmethod
+    def get_padrons(cls, vat_numbers, mode):
+        'Return a dictionary of the fresh cached padrons by VAT number'
+        limit = datetime.datetime.now() - cls.get_ttl()
+        padrons = {}
+        for sub_vat_numbers in grouped_slice(vat_numbers):
+            entries = cls.search([
+                    ('vat_number', 'in', list(sub_vat_numbers)),
+                    ('mode', '=', mode),
+                    ('fetch_date', '>', limit),
+                    ])
+            padrons.update(
+                (e.vat_number, Padron.from_dict(e.response)) for e in entries)
+        return padrons
+
+    @classmethod
+    def get_padron(cls, vat_number, mode):
+        return cls.get_padrons([vat_number], mode).get(vat_number)
+
+    @classmethod
+    def purge_expired(cls):
+        'Delete the answers older than the TTL'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        limit = datetime.datetime.now() - cls.get_ttl()
+        cursor.execute(*table.delete(where=table.fetch_date <= limit))
+
+    @classmethod
+    def set_padrons(cls, padrons, mode):
+        'Store the padron answers of the dictionary by VAT number'
+        existing = {}
+        for sub_vat_numbers in grouped_slice(list(padrons)):
+            existing.update((e.vat_number, e) for e in cls.search([
+                        ('vat_number', 'in', list(sub_vat_numbers)),
+                        ('mode', '=', mode),
+                        ]))
+        now = datetime.datetime.now()
+        to_write, to_create = [], []
+        for vat_number, padron in padrons.items():
+            values = {
+                'response': padron.to_dict(),
+                'fetch_date': now,
+                }
+            if vat_number in existing:
+                to_write.extend(([existing[vat_number]], values))
+            else:
+                to_create.append({
+                        'vat_number': vat_number,
+                        'mode': mode,
+                        **values,
+                        })
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def set_padron(cls, vat_number, mode, padron):
+        cls.set_padrons({vat_number: padron}, mode)
+
+
+class AFIPPadron(ModelSQL):
+    'AFIP Padron'
+    __name__ = 'afip.padron'
+
+    vat_number = fields.Char('VAT Number', required=True)
+    source = fields.Selection([
+        ('file', 'Contributor File'),
+        ('ws', 'Web Service'),
+        ], 'Source', required=True)
+    update_date = fields.DateTime('Update Date', required=True)
+    tipo_persona = fields.Char('Tipo Persona')
+    name = fields.Char('Name')
+    state = fields.Char('State')
+    iva_condition = fields.Char('IVA Condition')
+    ganancias_condition = fields.Char('Ganancias Condition')
+    monotributo = fields.Boolean('Monotributo')
+    primary_activity_code = fields.Char('Primary Activity Code')
+    secondary_activity_code = fields.Char('Secondary Activity Code')
+    start_activity_date = fields.Date('Start Activity Date')
+    street = fields.Char('Street')
+    city = fields.Char('City')
+    postal_code = fields.Char('Postal Code')
+    subdivision_code = fields.Integer('Subdivision Code')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('vat_number_uniq', Unique(t, t.vat_number),
+                'party_ar.msg_padron_unique'),
+            ]
+
+    @classmethod
+    def get_ttl(cls):
+        pool = Pool()
+        Configuration = pool.get('party.configuration')
+        return Configuration(1).padron_mirror_ttl or datetime.timedelta()
+
+    @classmethod
+    def get_padrons(cls, vat_numbers, complete=False):
+        '''
+        Return a dictionary of the fresh mirrored padrons by VAT number
+
+        With complete, only the entries filled from the web service, which
+        have the activities and the fiscal address, are returned.
+        '''
+        limit = datetime.datetime.now() - cls.get_ttl()
+        domain = [('update_date', '>', limit)]
+        if complete:
+            domain.append(('source', '=', 'ws'))
+        padrons = {}
+        for sub_vat_numbers in grouped_slice(vat_numbers):
+            entries = cls.search(domain + [
+                    ('vat_number', 'in', list(sub_vat_numbers)),
+                    ])
+            padrons.update((e.vat_number, e.to_padron()) for e in entries)
+        return padrons
+
+    @classmethod
+    def get_padron(cls, vat_number, complete=False):
+        return cls.get_padrons([vat_number], complete=complete).get(
+            vat_number)
+
+    @classmethod
+    def purge_expired(cls):
+        'Delete the entries older than the TTL'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        limit = datetime.datetime.now() - cls.get_ttl()
+        cursor.execute(*table.delete(where=table.update_date <= limit))
+
+    def to_padron(self):
+        'Return the Padron of the entry'
+        impuestos = []
+        if self.iva_condition in IVA_IMPUESTOS:
+            impuestos.append(IVA_IMPUESTOS[self.iva_condition])
+        if self.ganancias_condition in GANANCIAS_IMPUESTOS:
+            impuestos.append(GANANCIAS_IMPUESTOS[self.ganancias_condition])
+        data = {'estadoClave': self.state}
+        if self.tipo_persona == 'FISICA' and ', ' in (self.name or ''):
+            data['apellido'], data['nombre'] = self.name.split(', ', 1)
+        else:
+            data['razonSocial'] = self.name or ''
+        if self.start_activity_date:
+            data['fechaInscripcion'] = datetime.datetime.combine(
+                self.start_activity_date, datetime.time())
+        domicilios = []
+        if self.street or self.city:
+            domicilios.append({
+                    'tipoDomicilio': 'FISCAL',
+                    'direccion': self.street or '',
+                    'localidad': self.city or '',
+                    'codPostal': self.postal_code,
+                    'idProvincia': self.subdivision_code or 0,
+                    })
+        return Padron(
+            tipo_persona=self.tipo_persona or '',
+            data=data,
+            monotributo='S' if self.monotributo else 'N',
+            impuestos=impuestos,
+            actividades=[int(c) for c in [
+                    self.primary_activity_code,
+                    self.secondary_activity_code] if c],
+            domicilios=domicilios)
+
+    @classmethod
+    def values_from_padron(cls, padron):
+        'Return the values of the entry for the web service answer'
+        pool = Pool()
+        Party = pool.get('party.party')
+        iva_condition, ganancias_condition = Party.get_padron_conditions(
+            padron.impuestos, padron.monotributo)
+        if padron.tipo_persona == 'FISICA':
+            name = '%s, %s' % (
+                padron.data.get('apellido'), padron.data.get('nombre'))
+        else:
+            name = padron.data.get('razonSocial', '')
+        codes = [activity_code(a) for a in padron.actividades[:2]]
+        codes += [None] * (2 - len(codes))
+        fecha_inscripcion = padron.data.get('fechaInscripcion')
+        domicilio = next((d for d in padron.domicilios
+                if d.get('tipoDomicilio') == 'FISCAL'), {})
+        return {
+            'source': 'ws',
+            'update_date': datetime.datetime.now(),
+            'tipo_persona': padron.tipo_persona,
+            'name': name,
+            'state': padron.data.get('estadoClave'),
+            'iva_condition': iva_condition,
+            'ganancias_condition': ganancias_condition,
+            'monotributo': padron.monotributo == 'S',
+            'primary_activity_code': codes[0],
+            'secondary_activity_code': codes[1],
+            'start_activity_date': (
+                fecha_inscripcion.date() if fecha_inscripcion else None),
+            'street': domicilio.get('direccion'),
+            'city': domicilio.get('localidad'),
+            'postal_code': domicilio.get('codPostal'),
+            'subdivision_code': domicilio.get('idProvincia'),
+            }
+
+    @classmethod
+    def set_padrons(cls, padrons):
+        'Store the web service answers of the dictionary by VAT number'
+        padrons = {v: p for v, p in padrons.items() if p.data}
+        existing = {}
+        for sub_vat_numbers in grouped_slice(list(padrons)):
+            existing.update((e.vat_number, e) for e in cls.search([
+                        ('vat_number', 'in', list(sub_vat_numbers)),
+                        ]))
+        to_write, to_create = [], []
+        for vat_number, padron in padrons.items():
+            values = cls.values_from_padron(padron)
+            if vat_number in existing:
+                to_write.extend(([existing[vat_number]], values))
+            else:
+                to_create.append({'vat_number': vat_number, **values})
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def set_padron(cls, vat_number, padron):
+        cls.set_padrons({vat_number: padron})
+
+    @classmethod
+    def import_file(cls, path):
+        'Fill the mirror with the contributor file of AFIP'
+        return cls.import_records(read_padron_file(path))
+
+    @classmethod
+    def import_records(cls, records):
+        '''
+        Fill the mirror with the records of the contributor file
+
+        The records are inserted by batches. The entries filled from the web
+        service are kept as they are more complete.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        # the file has no state so it is left unknown
+        columns = [
+            table.vat_number, table.source, table.update_date,
+            table.name, table.iva_condition,
+            table.ganancias_condition, table.monotributo,
+            table.create_uid, table.create_date,
+            ]
+        # keep the bind parameters of each insert under the database limit
+        size = max(transaction.database.IN_MAX // len(columns), 1)
+        now = datetime.datetime.now()
+        count = 0
+        records = iter(records)
+        while True:
+            batch = {r['cuit']: r for r in islice(records, size)}
+            if not batch:
+                break
+            vat_numbers = list(batch)
+            cursor.execute(*table.delete(
+                    where=table.vat_number.in_(vat_numbers)
+                    & (table.source == 'file')))
+            cursor.execute(*table.select(table.vat_number,
+                    where=table.vat_number.in_(vat_numbers)))
+            for vat_number, in cursor:
+                del batch[vat_number]
+            values = []
+            for vat_number, record in batch.items():
+                impuestos, monotributo = padron_file_impuestos(record)
+                iva_condition, ganancias_condition = (
+                    Party.get_padron_conditions(impuestos, monotributo))
+                values.append([
+                        vat_number, 'file', now, record['denominacion'],
+                        iva_condition, ganancias_condition,
+                        monotributo == 'S', transaction.user, now])
+            if values:
+                cursor.execute(*table.insert(columns, values))
+                count += len(values)
+        logger.info('AFIP padron mirror: %s entries from the file.', count)
+        return count
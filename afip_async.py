@@ -0,0 +1,294 @@
+# This file is part of the party_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Optional asyncio client for the AFIP padron A5 web service.
+
+It keeps many requests in flight from a single thread and returns the same
+Padron objects as the pyafipws client. The access ticket is the one of the
+credentials as the WSAA login signs the ticket request with pyafipws.
+It requires httpx.
+'''
+import asyncio
+import datetime
+import html
+import logging
+import re
+import time
+import xml.etree.ElementTree as ET
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from trytond.config import config
+
+from .afip import (
+    as_list, add_personas, is_transient_error, circuit_breaker,
+    rate_limiter, PADRON_LIST_LIMIT)
+from .exceptions import AFIPUnavailable
+
+logger = logging.getLogger(__name__)
+
+PADRON_NS = 'http://a5.soap.ws.server.puc.sr/'
+ENVELOPE = (
+    '<soapenv:Envelope '
+    'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:ns="%(ns)s"><soapenv:Header/><soapenv:Body>'
+    '<ns:%(method)s>%(body)s</ns:%(method)s>'
+    '</soapenv:Body></soapenv:Envelope>')
+INTEGER_TAGS = {
+    'idPersona', 'idImpuesto', 'idActividad', 'idProvincia', 'orden',
+    'periodo', 'nomenclador', 'idCategoria', 'mesCierre',
+    }
+
+
+class SoapFault(Exception):
+    'Fault answered by an AFIP web service'
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def endpoint(wsdl):
+    'Return the service location of the WSDL URL'
+    return wsdl.split('?', 1)[0]
+
+
+def envelope(ns, method, **values):
+    body = ''.join('<%s>%s</%s>' % (k, html.escape(str(v)), k)
+        for k, vs in values.items() for v in as_list(vs))
+    return ENVELOPE % {'ns': ns, 'method': method, 'body': body}
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def element_to_python(element):
+    'Convert the element into dictionaries like pysimplesoap does'
+    children = list(element)
+    if not children:
+        text = (element.text or '').strip()
+        name = local_name(element.tag)
+        if name in INTEGER_TAGS and text.lstrip('-').isdigit():
+            return int(text)
+        elif name.startswith('fecha') and text:
+            try:
+                return datetime.datetime.fromisoformat(text)
+            except ValueError:
+                return text
+        return text
+    result = {}
+    for child in children:
+        name = local_name(child.tag)
+        value = element_to_python(child)
+        if name in result:
+            if not isinstance(result[name], list):
+                result[name] = [result[name]]
+            result[name].append(value)
+        else:
+            result[name] = value
+    return result
+
+
+def parse_response(content, name):
+    'Return the python value of the name element of the SOAP answer'
+    root = ET.fromstring(content)
+    for element in root.iter():
+        tag = local_name(element.tag)
+        if tag == 'Fault':
+            values = {local_name(c.tag): (c.text or '') for c in element}
+            raise SoapFault(
+                values.get('faultcode', ''), values.get('faultstring', ''))
+        elif tag == name:
+            return element_to_python(element)
+    return {}
+
+
+def ticket_values(ta):
+    'Return the token and sign of the access ticket'
+    values = {}
+    for tag in ['token', 'sign']:
+        match = re.search(r'<%s>([^<]+)</%s>' % (tag, tag), ta)
+        values[tag] = match.group(1) if match else ''
+    return values
+
+
+def is_transient(exception):
+    'Test if the exception is transient including the httpx transport errors'
+    return is_transient_error(exception) or bool(
+        httpx and isinstance(exception, httpx.TransportError))
+
+
+def is_fault_response(response):
+    'Test if the response is a SOAP fault answered with HTTP 500'
+    content_type = response.headers.get('content-type', '')
+    return response.status_code == 500 and content_type.startswith(
+        ('text/xml', 'application/soap+xml'))
+
+
+class AsyncAFIPClient(object):
+    '''
+    Asyncio client of the padron A5
+
+    At most concurrency requests are in flight at the same time.
+    '''
+
+    def __init__(self, credentials, concurrency=100, timeout=60,
+            transport=None):
+        if httpx is None:
+            raise RuntimeError('httpx is required for the asyncio client')
+        self.credentials = credentials
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.transport = transport
+        self.semaphore = None
+        self.client = None
+
+    async def __aenter__(self):
+        # the semaphore must be created inside the running loop
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout, transport=self.transport)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def call(self, url, ns, method, result, **values):
+        async with self.semaphore:
+            circuit_breaker.before()
+            await rate_limiter.acquire_async()
+            start = time.monotonic()
+            try:
+                response = await self.client.post(url,
+                    content=envelope(ns, method, **values).encode('utf-8'),
+                    headers={
+                        'Content-Type': 'text/xml; charset=utf-8',
+                        'SOAPAction': '""',
+                        })
+                if is_fault_response(response):
+                    parse_response(response.content, 'Fault')
+                # the gateways answer errors with HTML bodies
+                response.raise_for_status()
+                value = parse_response(response.content, result)
+            except Exception as e:
+                if is_transient(e):
+                    rate_limiter.failure()
+                    circuit_breaker.failure()
+                else:
+                    rate_limiter.success(time.monotonic() - start)
+                    circuit_breaker.success()
+                raise
+            rate_limiter.success(time.monotonic() - start)
+            circuit_breaker.success()
+            return value
+
+    def _auth_values(self):
+        values = ticket_values(self.credentials['ta'])
+        values['cuitRepresentada'] = self.credentials['cuit']
+        return values
+
+    async def fetch_padrons(self, vat_numbers, stats=None):
+        '''
+        Return the (vat_number, padron, exception) of the VAT numbers
+
+        The batches of getPersonaList_v2 are sent concurrently. The batches
+        that failed because AFIP throttled or timed out are sent again with
+        an exponential backoff and the failure of a batch does not discard
+        the answers of the others.
+        '''
+        retries = config.getint('party_ar', 'afip_retries', default=3)
+        retry_delay = config.getfloat(
+            'party_ar', 'afip_retry_delay', default=10)
+        if stats is None:
+            stats = {}
+        stats.setdefault('retries', 0)
+
+        async def query(batch, attempt=0):
+            try:
+                return await self.call(
+                    endpoint(self.credentials['wsdl']), PADRON_NS,
+                    'getPersonaList_v2', 'personaListReturn',
+                    idPersona=batch, **self._auth_values())
+            except Exception as e:
+                if not is_transient(e) or attempt >= retries:
+                    raise
+                stats['retries'] += 1
+                logger.warning('Retrying %s CUITs in %ss: "%s".',
+                    len(batch), retry_delay * 2 ** attempt, e)
+            await asyncio.sleep(retry_delay * 2 ** attempt)
+            return await query(batch, attempt + 1)
+
+        vat_numbers = list(vat_numbers)
+        batches = [vat_numbers[i:i + PADRON_LIST_LIMIT]
+            for i in range(0, len(vat_numbers), PADRON_LIST_LIMIT)]
+        results = await asyncio.gather(
+            *(query(batch) for batch in batches), return_exceptions=True)
+        fetched, unavailable = [], []
+        for batch, ret in zip(batches, results):
+            if isinstance(ret, AFIPUnavailable):
+                unavailable.extend((v, None, ret) for v in batch)
+                continue
+            elif isinstance(ret, Exception):
+                fetched.extend((v, None, ret) for v in batch)
+                continue
+            padrons, errors = {}, {}
+            add_personas(as_list((ret or {}).get('persona')), batch,
+                padrons, errors)
+            for vat_number in batch:
+                padron = padrons.get(vat_number)
+                if padron:
+                    fetched.append((vat_number, padron, None))
+                else:
+                    fetched.append((vat_number, None, ValueError(
+                                errors.get(vat_number, ''))))
+        # the unavailable batches come last as they stop the caller
+        return fetched + unavailable
+
+    async def consultar_list(self, vat_numbers):
+        '''
+        Return the Padron and error messages of the VAT numbers
+
+        The batches of getPersonaList_v2 are sent concurrently and the
+        failures are returned as error messages.
+        '''
+        padrons, errors = {}, {}
+        for vat_number, padron, error in await self.fetch_padrons(
+                vat_numbers):
+            if padron:
+                padrons[vat_number] = padron
+            else:
+                errors[vat_number] = str(error)
+        return padrons, errors
+
+
+def fetch_padrons(credentials, vat_numbers, concurrency=100, transport=None,
+        stats=None):
+    '''
+    Return the (vat_number, padron, exception) of the VAT numbers
+
+    It is the asyncio equivalent of party.party._fetch_padrons.
+    '''
+    async def fetch():
+        async with AsyncAFIPClient(credentials, concurrency=concurrency,
+                transport=transport) as client:
+            return await client.fetch_padrons(vat_numbers, stats=stats)
+    return asyncio.run(fetch())
+
+
+def query_padron_list(credentials, vat_numbers, concurrency=100,
+        transport=None):
+    '''
+    Query the padron for the VAT numbers with the asyncio client
+
+    It is the asyncio equivalent of afip.query_padron_list.
+    '''
+    async def query():
+        async with AsyncAFIPClient(credentials, concurrency=concurrency,
+                transport=transport) as client:
+            return await client.consultar_list(vat_numbers)
+    return asyncio.run(query())
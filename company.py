@@ -8,6 +8,9 @@ from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.transaction import Transaction
+
+from .afip import padron_clients
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +35,27 @@ class Company(metaclass=PoolMeta):
     def default_pyafipws_mode_cert():
         return ''
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        actions = iter(args)
+        for companies, values in zip(actions, actions):
+            if values.keys() & {'pyafipws_certificate',
+                    'pyafipws_private_key', 'pyafipws_mode_cert'}:
+                cls._invalidate_padron_clients(companies)
+
+    @classmethod
+    def delete(cls, companies):
+        cls._invalidate_padron_clients(companies)
+        super().delete(companies)
+
+    @classmethod
+    def _invalidate_padron_clients(cls, companies):
+        database = Transaction().database.name
+        ids = {c.id for c in companies}
+        padron_clients.invalidate(
+            lambda key: key[0] == database and key[1] in ids)
+
     @classmethod
     def validate(cls, companies):
         super().validate(companies)
@@ -0,0 +1,104 @@
+# This file is part of the party_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+
+# ISO 3166-2 code of the provinces by AFIP idProvincia
+PROVINCIAS_ISO = {
+    0: 'AR-C',
+    1: 'AR-B',
+    2: 'AR-K',
+    3: 'AR-X',
+    4: 'AR-W',
+    5: 'AR-E',
+    6: 'AR-Y',
+    7: 'AR-M',
+    8: 'AR-F',
+    9: 'AR-A',
+    10: 'AR-J',
+    11: 'AR-D',
+    12: 'AR-S',
+    13: 'AR-G',
+    14: 'AR-T',
+    16: 'AR-H',
+    17: 'AR-U',
+    18: 'AR-P',
+    19: 'AR-N',
+    20: 'AR-Q',
+    21: 'AR-L',
+    22: 'AR-R',
+    23: 'AR-Z',
+    24: 'AR-V',
+    }
+
+
+class Country(metaclass=PoolMeta):
+    __name__ = 'country.country'
+    _afip_ids_cache = Cache('country.country.afip_ids', context=False)
+
+    @classmethod
+    def get_afip_ids(cls):
+        '''
+        Return the id of Argentina and a dictionary of the subdivision ids by
+        AFIP idProvincia.
+        '''
+        pool = Pool()
+        Subdivision = pool.get('country.subdivision')
+        ids = cls._afip_ids_cache.get(None)
+        if ids is None:
+            countries = cls.search([('code', '=', 'AR')], limit=1)
+            subdivisions = Subdivision.search([
+                    ('code', 'in', list(PROVINCIAS_ISO.values())),
+                    ])
+            subdivision_ids = {s.code: s.id for s in subdivisions}
+            ids = [
+                countries[0].id if countries else None,
+                [(p, subdivision_ids[c]) for p, c in PROVINCIAS_ISO.items()
+                    if c in subdivision_ids],
+                ]
+            cls._afip_ids_cache.set(None, ids)
+        country_id, subdivision_ids = ids
+        return country_id, dict(subdivision_ids)
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._afip_ids_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._afip_ids_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        cls._afip_ids_cache.clear()
+
+
+class Subdivision(metaclass=PoolMeta):
+    __name__ = 'country.subdivision'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Country = pool.get('country.country')
+        records = super().create(vlist)
+        Country._afip_ids_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Country = pool.get('country.country')
+        super().write(*args)
+        Country._afip_ids_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Country = pool.get('country.country')
+        super().delete(records)
+        Country._afip_ids_cache.clear()
@@ -15,3 +15,7 @@ class VatNumberNotFound(UserError):
 
 class PyAfipWsError(UserError):
     pass
+
+
+class AFIPUnavailable(PyAfipWsError):
+    pass
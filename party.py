@@ -1,24 +1,41 @@
 # This file is part of the party_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from sql.conditionals import Case
-from sql import Literal, Null
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import datetime
+import hashlib
+from heapq import heappop, heappush
+import json
+import re
+from itertools import count
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, Lower
+from sql import Column, Literal, Null, Values
 
-from pyafipws.ws_sr_padron import WSSrPadronA5
 import stdnum.ar.cuit as cuit
 import stdnum.exceptions
+from stdnum.util import clean
 import logging
+import time
 
-from trytond.model import ModelView, ModelSQL, fields
+from trytond.cache import Cache
+from trytond.config import config as config_
+from trytond.model import Model, ModelView, ModelSQL, Index, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval, Equal
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
-from trytond.tools import cursor_dict
+from trytond.tools import cursor_dict, grouped_slice, reduce_ids
 from trytond.modules.party.exceptions import InvalidIdentifierCode
-from .exceptions import CompanyNotDefined, VatNumberNotFound
-from .actividades import CODES
+from .afip import (
+    Padron, padron_client, afip_call, is_transient_error, query_padron_list,
+    read_padron_file, padron_file_impuestos, activity_code,
+    activity_code_clause, PADRON_LIST_LIMIT)
+from .exceptions import (
+    AFIPUnavailable, CompanyNotDefined, VatNumberNotFound)
+from .validation import check_cuits
 
 logger = logging.getLogger(__name__)
 
@@ -91,9 +108,108 @@ PROVINCIAS = {
     }
 
 
+# map ISO country code to AFIP destination country code:
+PAIS_DST_CMP = {
+    'bf': 101, 'dz': 102, 'bw': 103, 'bi': 104, 'cm': 105,
+    'cf': 107, 'cg': 108, 'cd': 109, 'ci': 110, 'td': 111,
+    'bj': 112, 'eg': 113, 'ga': 115, 'gm': 116, 'gh': 117,
+    'gn': 118, 'gq': 119, 'ke': 120, 'ls': 121, 'lr': 122,
+    'ly': 123, 'mg': 124, 'mw': 125, 'ml': 126, 'ma': 127,
+    'mu': 128, 'mr': 129, 'ne': 130, 'ng': 131, 'zw': 132,
+    'rw': 133, 'sn': 134, 'sl': 135, 'so': 136, 'sz': 137,
+    'sd': 138, 'tz': 139, 'tg': 140, 'tn': 141, 'ug': 142,
+    'zm': 144, 'ao': 149, 'cv': 150, 'mz': 151, 'sc': 152,
+    'dj': 153, 'km': 155, 'gw': 156, 'st': 157, 'na': 158,
+    'za': 159, 'er': 160, 'et': 161, 'ar': 200, 'bb': 201,
+    'bo': 202, 'br': 203, 'ca': 204, 'co': 205, 'cr': 206,
+    'cu': 207, 'cl': 208, 'do': 209, 'ec': 210, 'sv': 211,
+    'us': 212, 'gt': 213, 'gy': 214, 'ht': 215, 'hn': 216,
+    'jm': 217, 'mx': 218, 'ni': 219, 'pa': 220, 'py': 221,
+    'pe': 222, 'pr': 223, 'tt': 224, 'uy': 225, 've': 226,
+    'sr': 232, 'dm': 233, 'lc': 234, 'vc': 235, 'bz': 236,
+    'ag': 237, 'kn': 238, 'bs': 239, 'gd': 240, 'af': 301,
+    'sa': 302, 'bh': 303, 'mm': 304, 'bt': 305, 'kh': 306,
+    'lk': 307, 'kp': 308, 'kr': 309, 'cn': 310, 'ph': 312,
+    'tw': 313, 'in': 315, 'id': 316, 'iq': 317, 'ir': 318,
+    'il': 319, 'jp': 320, 'jo': 321, 'qa': 322, 'kw': 323,
+    'la': 324, 'lb': 325, 'my': 326, 'mv': 327, 'om': 328,
+    'mn': 329, 'np': 330, 'ae': 331, 'pk': 332, 'sg': 333,
+    'sy': 334, 'th': 335, 'vn': 337, 'hk': 341, 'mo': 344,
+    'bd': 345, 'bn': 346, 'ye': 348, 'am': 349, 'az': 350,
+    'ge': 351, 'kz': 352, 'kg': 353, 'tj': 354, 'tm': 355,
+    'uz': 356, 'ps': 357, 'al': 401, 'ad': 404, 'at': 405,
+    'be': 406, 'bg': 407, 'dk': 409, 'es': 410, 'fi': 411,
+    'fr': 412, 'gr': 413, 'hu': 414, 'ie': 415, 'is': 416,
+    'it': 417, 'li': 418, 'lu': 419, 'mt': 420, 'mc': 421,
+    'no': 422, 'nl': 423, 'pl': 424, 'pt': 425, 'gb': 426,
+    'ro': 427, 'sm': 428, 'se': 429, 'ch': 430, 'va': 431,
+    'cy': 435, 'tr': 436, 'de': 438, 'by': 439, 'ee': 440,
+    'lv': 441, 'lt': 442, 'md': 443, 'ru': 444, 'ua': 445,
+    'ba': 446, 'hr': 447, 'sk': 448, 'si': 449, 'mk': 450,
+    'cz': 451, 'me': 453, 'rs': 454, 'au': 501, 'nr': 503,
+    'nz': 504, 'vu': 505, 'ws': 506, 'fj': 512, 'pg': 513,
+    'ki': 514, 'fm': 515, 'pw': 516, 'tv': 517, 'sb': 518,
+    'to': 519, 'mh': 520, 'mp': 521,
+    }
+
+
+def pais_dst_cmp_values():
+    'Return the ISO to AFIP country code mapping as a VALUES table'
+    return Values([[iso, str(dst)] for iso, dst in PAIS_DST_CMP.items()])
+
+
+def normalize_code(value):
+    'Return the identifier code without the separators typed by users'
+    if isinstance(value, str):
+        return clean(value, ' -./').strip()
+    return value
+
+
+def normalize_code_clause(clause):
+    'Return the clause on an identifier code with normalized values'
+    _, operator, value = clause[:3]
+    if operator.endswith('in') and isinstance(value, (list, tuple)):
+        value = [normalize_code(v) for v in value]
+    else:
+        value = normalize_code(value)
+    return (clause[0], operator, value) + tuple(clause[3:])
+
+
+def normalize_address(value):
+    'Return the value of an address field normalized for comparison'
+    if isinstance(value, str):
+        return ' '.join(value.split()).casefold() or None
+    return value
+
+
+def address_value(address, name):
+    'Return the value of the address field as stored in the values'
+    value = getattr(address, name, None)
+    if isinstance(value, Model):
+        return value.id
+    return value
+
+
 class Configuration(metaclass=PoolMeta):
     __name__ = 'party.configuration'
 
+    padron_cache_ttl = fields.TimeDelta('Padron Cache TTL',
+        help='Time during which an answer of the AFIP padron is reused.')
+    padron_mirror_ttl = fields.TimeDelta('Padron Mirror TTL',
+        help='Time during which an entry of the local padron mirror is used '
+        'instead of querying AFIP.')
+    census_workers = fields.Integer('Census Workers', required=True,
+        domain=[('census_workers', '>=', 1)],
+        help='Number of concurrent AFIP padron lookups done by the census.')
+    census_asyncio = fields.Boolean('Census with asyncio',
+        help='Send the lookups of the census from a single thread with the '
+        'asyncio client which requires httpx.')
+    census_ttl = fields.TimeDelta('Census TTL', required=True,
+        help='Minimum time before the census queries a party again.')
+    census_max_ttl = fields.TimeDelta('Census Maximum TTL', required=True,
+        help='The TTL doubles each time AFIP returns the same data for a '
+        'party up to this value.')
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -101,6 +217,30 @@ class Configuration(metaclass=PoolMeta):
                 ('ar_foreign', 'CUIT AFIP Foreign'),
                 ]
 
+    @classmethod
+    def default_padron_cache_ttl(cls):
+        return datetime.timedelta(hours=1)
+
+    @classmethod
+    def default_padron_mirror_ttl(cls):
+        return datetime.timedelta(days=30)
+
+    @classmethod
+    def default_census_workers(cls):
+        return 4
+
+    @classmethod
+    def default_census_asyncio(cls):
+        return False
+
+    @classmethod
+    def default_census_ttl(cls):
+        return datetime.timedelta(days=20)
+
+    @classmethod
+    def default_census_max_ttl(cls):
+        return datetime.timedelta(days=180)
+
 
 class AFIPVatCountry(ModelSQL, ModelView):
     'AFIP Vat Country'
@@ -113,6 +253,37 @@ class AFIPVatCountry(ModelSQL, ModelView):
         ('1', 'Física'),
         ('2', 'Otro Tipo de Entidad'),
         ], 'Type Code')
+    _vat_numbers_cache = Cache(
+        'party.afip_vat_country.vat_numbers', context=False)
+
+    @classmethod
+    def get_vat_numbers(cls):
+        'Return the frozenset of (afip country id, VAT number) pairs'
+        vat_numbers = cls._vat_numbers_cache.get(None)
+        if vat_numbers is None:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.select(table.afip_country, table.vat_number,
+                    where=table.afip_country != Null))
+            vat_numbers = frozenset(tuple(r) for r in cursor)
+            cls._vat_numbers_cache.set(None, vat_numbers)
+        return vat_numbers
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._vat_numbers_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._vat_numbers_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        cls._vat_numbers_cache.clear()
 
     @classmethod
     def __register__(cls, module_name):
@@ -125,73 +296,15 @@ class AFIPVatCountry(ModelSQL, ModelView):
 
         table_h = cls.__table_handler__(module_name)
 
-        # map ISO country code to AFIP destination country code:
-        pais_dst_cmp = {
-            'bf': 101, 'dz': 102, 'bw': 103, 'bi': 104, 'cm': 105,
-            'cf': 107, 'cg': 108, 'cd': 109, 'ci': 110, 'td': 111,
-            'bj': 112, 'eg': 113, 'ga': 115, 'gm': 116, 'gh': 117,
-            'gn': 118, 'gq': 119, 'ke': 120, 'ls': 121, 'lr': 122,
-            'ly': 123, 'mg': 124, 'mw': 125, 'ml': 126, 'ma': 127,
-            'mu': 128, 'mr': 129, 'ne': 130, 'ng': 131, 'zw': 132,
-            'rw': 133, 'sn': 134, 'sl': 135, 'so': 136, 'sz': 137,
-            'sd': 138, 'tz': 139, 'tg': 140, 'tn': 141, 'ug': 142,
-            'zm': 144, 'ao': 149, 'cv': 150, 'mz': 151, 'sc': 152,
-            'dj': 153, 'km': 155, 'gw': 156, 'st': 157, 'na': 158,
-            'za': 159, 'er': 160, 'et': 161, 'ar': 200, 'bb': 201,
-            'bo': 202, 'br': 203, 'ca': 204, 'co': 205, 'cr': 206,
-            'cu': 207, 'cl': 208, 'do': 209, 'ec': 210, 'sv': 211,
-            'us': 212, 'gt': 213, 'gy': 214, 'ht': 215, 'hn': 216,
-            'jm': 217, 'mx': 218, 'ni': 219, 'pa': 220, 'py': 221,
-            'pe': 222, 'pr': 223, 'tt': 224, 'uy': 225, 've': 226,
-            'sr': 232, 'dm': 233, 'lc': 234, 'vc': 235, 'bz': 236,
-            'ag': 237, 'kn': 238, 'bs': 239, 'gd': 240, 'af': 301,
-            'sa': 302, 'bh': 303, 'mm': 304, 'bt': 305, 'kh': 306,
-            'lk': 307, 'kp': 308, 'kr': 309, 'cn': 310, 'ph': 312,
-            'tw': 313, 'in': 315, 'id': 316, 'iq': 317, 'ir': 318,
-            'il': 319, 'jp': 320, 'jo': 321, 'qa': 322, 'kw': 323,
-            'la': 324, 'lb': 325, 'my': 326, 'mv': 327, 'om': 328,
-            'mn': 329, 'np': 330, 'ae': 331, 'pk': 332, 'sg': 333,
-            'sy': 334, 'th': 335, 'vn': 337, 'hk': 341, 'mo': 344,
-            'bd': 345, 'bn': 346, 'ye': 348, 'am': 349, 'az': 350,
-            'ge': 351, 'kz': 352, 'kg': 353, 'tj': 354, 'tm': 355,
-            'uz': 356, 'ps': 357, 'al': 401, 'ad': 404, 'at': 405,
-            'be': 406, 'bg': 407, 'dk': 409, 'es': 410, 'fi': 411,
-            'fr': 412, 'gr': 413, 'hu': 414, 'ie': 415, 'is': 416,
-            'it': 417, 'li': 418, 'lu': 419, 'mt': 420, 'mc': 421,
-            'no': 422, 'nl': 423, 'pl': 424, 'pt': 425, 'gb': 426,
-            'ro': 427, 'sm': 428, 'se': 429, 'ch': 430, 'va': 431,
-            'cy': 435, 'tr': 436, 'de': 438, 'by': 439, 'ee': 440,
-            'lv': 441, 'lt': 442, 'md': 443, 'ru': 444, 'ua': 445,
-            'ba': 446, 'hr': 447, 'sk': 448, 'si': 449, 'mk': 450,
-            'cz': 451, 'me': 453, 'rs': 454, 'au': 501, 'nr': 503,
-            'nz': 504, 'vu': 505, 'ws': 506, 'fj': 512, 'pg': 513,
-            'ki': 514, 'fm': 515, 'pw': 516, 'tv': 517, 'sb': 518,
-            'to': 519, 'mh': 520, 'mp': 521,
-            }
-
         # Migration legacy: vat_country -> afip_country
         if table_h.column_exist('vat_country'):
-            cursor.execute(*table.select(
-                    table.id, table.vat_country))
-
-            for id, vat_country_id in cursor.fetchall():
-                if vat_country_id:
-                    cursor.execute(*country.select(country.code,
-                            where=(country.id == vat_country_id)))
-                    row = cursor.fetchone()
-                    if not row:
-                        continue
-                    dst = pais_dst_cmp.get(row[0].lower(), None)
-                    if not dst:
-                        continue
-                    cursor.execute(*afip_country.select(afip_country.id,
-                            where=(afip_country.code == str(dst))))
-                    row = cursor.fetchone()
-                    if not row:
-                        continue
-                    cursor.execute(*table.update(
-                        [table.afip_country], [row[0]],
-                        where=table.id == id))
+            mapping = pais_dst_cmp_values()
+            cursor.execute(*table.update(
+                    [table.afip_country], [afip_country.id],
+                    from_=[country, mapping, afip_country],
+                    where=(table.vat_country == country.id)
+                    & (Lower(country.code) == mapping.column1)
+                    & (afip_country.code == mapping.column2)))
             table_h.drop_column('vat_country')
 
 
@@ -243,10 +356,16 @@ class Party(metaclass=PoolMeta):
         ('estado', 'Estado'),
         ('exterior', 'Exterior'),
         ], 'Company Type')
-    primary_activity_code = fields.Selection(CODES,
-        'Primary Activity Code')
-    secondary_activity_code = fields.Selection(CODES,
-        'Secondary Activity Code')
+    primary_activity = fields.Many2One('afip.activity', 'Primary Activity',
+        ondelete='RESTRICT')
+    secondary_activity = fields.Many2One('afip.activity',
+        'Secondary Activity', ondelete='RESTRICT')
+    primary_activity_code = fields.Function(fields.Char(
+            'Primary Activity Code'),
+        'get_activity_code', searcher='search_activity_code')
+    secondary_activity_code = fields.Function(fields.Char(
+            'Secondary Activity Code'),
+        'get_activity_code', searcher='search_activity_code')
     start_activity_date = fields.Date('Start activity date')
     controlling_entity = fields.Char('Entidad controladora',
         help='Controlling entity')
@@ -258,20 +377,51 @@ class Party(metaclass=PoolMeta):
         states={
             'required': Bool(Eval('iva_condition').in_(
                 ['responsable_inscripto', 'exento', 'monotributo'])),
-            }), 'get_vat_number', setter='set_vat_number',
+            }), 'get_vat_numbers', setter='set_vat_number',
         searcher='search_vat_number')
     vat_number_afip_foreign = fields.Function(fields.Char('CUIT AFIP Foreign'),
-        'get_vat_number_afip_foreign',
+        'get_vat_numbers',
         searcher='search_vat_number_afip_foreign')
+    afip_sync_date = fields.DateTime('Last AFIP Sync', readonly=True)
+    afip_sync_next = fields.DateTime('Next AFIP Sync', readonly=True)
+    afip_sync_hash = fields.Char('AFIP Sync Hash', readonly=True)
+    afip_sync_unchanged = fields.Integer('AFIP Sync Unchanged', readonly=True,
+        help='Number of consecutive syncs without changes on the padron.')
 
     @classmethod
     def __register__(cls, module_name):
+        pool = Pool()
+        AFIPActivity = pool.get('afip.activity')
         cursor = Transaction().connection.cursor()
         sql_table = cls.__table__()
+        activity = AFIPActivity.__table__()
         table_h = cls.__table_handler__(module_name)
 
         iibb_type_exist = table_h.column_exist('iibb_type')
+        activity_code_exist = table_h.column_exist('primary_activity_code')
         super().__register__(module_name)
+
+        # Migration from activity codes to afip.activity
+        if activity_code_exist:
+            for name in ['primary_activity', 'secondary_activity']:
+                column = Column(sql_table, name + '_code')
+                cursor.execute(*sql_table.select(column, distinct=True,
+                        where=(column != Null) & (column != '')
+                        & ~column.in_(activity.select(activity.code))))
+                codes = [c for c, in cursor]
+                if codes:
+                    # codes no longer listed in the F883 file
+                    from .actividades import CODES
+                    labels = dict(CODES)
+                    AFIPActivity.create([{
+                                'code': c,
+                                'name': labels.get(c, c).split(' - ', 1)[-1],
+                                } for c in codes])
+                cursor.execute(*sql_table.update(
+                        [Column(sql_table, name)], [activity.id],
+                        from_=[activity],
+                        where=activity.code == column))
+                table_h.drop_column(name + '_code')
         if iibb_type_exist:
             cursor.execute(*sql_table.update([sql_table.iibb_condition], [
                 Case((sql_table.iibb_type == 'cm', 'cm'),
@@ -288,10 +438,30 @@ class Party(metaclass=PoolMeta):
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.afip_sync_next, Index.Range())),
+                Index(t, (t.primary_activity, Index.Equality()),
+                    where=t.primary_activity != Null),
+                Index(t, (t.secondary_activity, Index.Equality()),
+                    where=t.secondary_activity != Null),
+                })
         cls._buttons.update({
             'get_afip_data': {},
             })
 
+    @classmethod
+    def copy(cls, parties, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('afip_sync_date', None)
+        default.setdefault('afip_sync_next', None)
+        default.setdefault('afip_sync_hash', None)
+        default.setdefault('afip_sync_unchanged', None)
+        return super().copy(parties, default=default)
+
     @staticmethod
     def default_tipo_documento():
         return '80'
@@ -302,11 +472,67 @@ class Party(metaclass=PoolMeta):
         types.extend(['ar_dni', 'ar_foreign'])
         return types
 
-    def get_vat_number(self, name):
-        types = ['ar_vat', 'ar_dni']
-        for identifier in self.identifiers:
-            if identifier.type in types:
-                return identifier.code
+    @fields.depends('vat_number', 'name', 'iva_condition',
+        'ganancias_condition')
+    def on_change_vat_number(self):
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        if not self.vat_number or self.name:
+            return
+        padron = AFIPPadron.get_padron(cuit.compact(self.vat_number))
+        if padron:
+            values = AFIPPadron.values_from_padron(padron)
+            self.name = values['name']
+            self.iva_condition = values['iva_condition']
+            self.ganancias_condition = values['ganancias_condition']
+
+    def get_activity_code(self, name):
+        activity = getattr(self, name[:-len('_code')])
+        if activity:
+            return activity.code
+
+    @classmethod
+    def search_activity_code(cls, name, clause):
+        return [activity_code_clause(
+                (name[:-len('_code')] + '.code',) + tuple(clause[1:]))]
+
+    @classmethod
+    def get_vat_numbers(cls, parties, names):
+        '''
+        Return the code of the first identifier of each party for
+        vat_number and vat_number_afip_foreign.
+
+        The identifiers of all the parties are read with one query.
+        '''
+        pool = Pool()
+        PartyIdentifier = pool.get('party.identifier')
+        identifier = PartyIdentifier.__table__()
+        cursor = Transaction().connection.cursor()
+
+        name_types = {
+            'vat_number': ['ar_vat', 'ar_dni'],
+            'vat_number_afip_foreign': ['ar_foreign'],
+            }
+        type_names = {t: n for n in names for t in name_types[n]}
+        result = {n: {p.id: None for p in parties} for n in names}
+        rows = []
+        for sub_ids in grouped_slice([p.id for p in parties]):
+            where = (reduce_ids(identifier.party, sub_ids)
+                & identifier.type.in_(list(type_names)))
+            if 'active' in PartyIdentifier._fields:
+                where &= identifier.active == Literal(True)
+            cursor.execute(*identifier.select(
+                    identifier.party, identifier.type, identifier.code,
+                    identifier.sequence, identifier.id,
+                    where=where))
+            rows.extend(cursor)
+        # same order as the identifiers field
+        rows.sort(key=lambda r: (r[3] is not None, r[3] or 0, r[4]))
+        for party_id, type_, code, _, _ in rows:
+            values = result[type_names[type_]]
+            if values[party_id] is None:
+                values[party_id] = code
+        return result
 
     @classmethod
     def set_vat_number(cls, partys, name, value):
@@ -314,65 +540,64 @@ class Party(metaclass=PoolMeta):
         PartyIdentifier = pool.get('party.identifier')
 
         types = ['ar_vat', 'ar_dni']
-        party = partys[0]
-        identifiers = PartyIdentifier.search([
-            ('party', '=', party),
-            ('type', 'in', types),
-            ])
+        identifiers = []
+        for sub_partys in grouped_slice(partys):
+            identifiers.extend(PartyIdentifier.search([
+                ('party', 'in', [p.id for p in sub_partys]),
+                ('type', 'in', types),
+                ]))
         PartyIdentifier.delete(identifiers)
         if not value:
             return
-        if party.tipo_documento in ('80', '86'):  # CUIT, CUIL
-            type = 'ar_vat'
-        else:
-            type = 'ar_dni'
-        PartyIdentifier.create([{
-            'code': cuit.compact(value),
-            'type': type,
-            'party': party.id,
-            }])
+        to_create = []
+        for party in partys:
+            if party.tipo_documento in ('80', '86'):  # CUIT, CUIL
+                type = 'ar_vat'
+            else:
+                type = 'ar_dni'
+            to_create.append({
+                'code': cuit.compact(value),
+                'type': type,
+                'party': party.id,
+                })
+        PartyIdentifier.create(to_create)
 
     @classmethod
     def search_vat_number(cls, name, clause):
         types = ['ar_vat', 'ar_dni']
-        return [
-            ('identifiers.code',) + tuple(clause[1:]),
-            ('identifiers.type', 'in', types),
-            ]
-
-    def get_vat_number_afip_foreign(self, name):
-        for identifier in self.identifiers:
-            if identifier.type == 'ar_foreign':
-                return identifier.code
+        return [('identifiers', 'where', [
+                    ('code',) + tuple(normalize_code_clause(clause)[1:]),
+                    ('type', 'in', types),
+                    ])]
 
     @classmethod
     def search_vat_number_afip_foreign(cls, name, clause):
-        return [
-            ('identifiers.code',) + tuple(clause[1:]),
-            ('identifiers.type', '=', 'ar_foreign'),
-            ]
+        # the foreign codes are stored as typed
+        return [('identifiers', 'where', [
+                    ('code',) + tuple(clause[1:]),
+                    ('type', '=', 'ar_foreign'),
+                    ])]
 
     @classmethod
-    def get_ws_afip(cls, vat_number):
-        # authenticate against AFIP:
+    def get_afip_company(cls):
         pool = Pool()
         Company = pool.get('company.company')
         if Transaction().context.get('company'):
-            company = Company(Transaction().context['company'])
-        else:
-            logger.error('The company is not defined')
-            raise CompanyNotDefined(gettext(
-                'party_ar.msg_company_not_defined'))
+            return Company(Transaction().context['company'])
+        logger.error('The company is not defined')
+        raise CompanyNotDefined(gettext('party_ar.msg_company_not_defined'))
 
-        ws = WSSrPadronA5()
-        ws.LanzarExcepciones = True
-        cache = Company.get_cache_dir()
+    @classmethod
+    def get_ws_afip_credentials(cls, company=None):
+        'Return the credentials to query the AFIP padron for the company'
+        pool = Pool()
+        Company = pool.get('company.company')
+        if company is None:
+            company = cls.get_afip_company()
 
-        # set AFIP webservice credentials
+        # authenticate against AFIP:
         ta = company.pyafipws_authenticate(
             service='ws_sr_constancia_inscripcion')
-        ws.SetTicketAcceso(ta)
-        ws.Cuit = company.party.vat_number
 
         if company.pyafipws_mode_cert == 'homologacion':
             WSDL = ('https://awshomo.afip.gov.ar/sr-padron/webservices/'
@@ -380,90 +605,362 @@ class Party(metaclass=PoolMeta):
         elif company.pyafipws_mode_cert == 'produccion':
             WSDL = ('https://aws.afip.gov.ar/sr-padron/webservices/'
                 'personaServiceA5?wsdl')
-        # connect to the webservice and call to the test method
-        ws.Conectar(wsdl=WSDL, cache=cache, cacert=True)
-        ws.Consultar(vat_number)
-        return ws
+        return {
+            'database': Transaction().database.name,
+            'company': company.id,
+            'ta': ta,
+            'cuit': company.party.vat_number,
+            'mode': company.pyafipws_mode_cert,
+            'wsdl': WSDL,
+            'cache': Company.get_cache_dir(),
+            }
+
+    @classmethod
+    def get_ws_afip(cls, vat_number, force=False):
+        '''
+        Return the Padron of vat_number.
+
+        The answer is read from the padron cache unless force is set.
+        The Padron has the attributes of WSSrPadronA5 used by party_ar but
+        not the client methods.
+        '''
+        pool = Pool()
+        PadronCache = pool.get('afip.padron.cache')
+        company = cls.get_afip_company()
+        mode = company.pyafipws_mode_cert
+        if not force:
+            padron = PadronCache.get_padron(vat_number, mode)
+            if padron:
+                return padron
+        padron = cls.query_ws_afip(
+            cls.get_ws_afip_credentials(company), vat_number)
+        if padron.data:
+            PadronCache.set_padron(vat_number, mode, padron)
+        return padron
+
+    @classmethod
+    def get_afip_padron(cls, vat_number, force=False):
+        '''
+        Return the padron of vat_number from the local mirror.
+
+        AFIP is queried when force is set or when the mirror entry is
+        missing, stale or incomplete and its answer is stored in the mirror.
+        '''
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        padron = None
+        if not force:
+            padron = AFIPPadron.get_padron(vat_number, complete=True)
+        if not padron:
+            padron = cls.get_ws_afip(vat_number, force=force)
+            AFIPPadron.set_padron(vat_number, padron)
+        return padron
+
+    @classmethod
+    def get_ws_afip_list(cls, vat_numbers, force=False, use_asyncio=False,
+            stats=None):
+        '''
+        Return the padrons and the error messages of many VAT numbers.
+
+        The answers are read from the padron cache unless force is set and
+        the missing ones are queried by batches with getPersonaList by
+        census_workers threads. With use_asyncio, census_workers batches are
+        sent concurrently by the asyncio client which requires httpx.
+        The fetched answers are stored in the padron cache and in the padron
+        mirror even when AFIPUnavailable is raised.
+        '''
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        Configuration = pool.get('party.configuration')
+        PadronCache = pool.get('afip.padron.cache')
+        company = cls.get_afip_company()
+        mode = company.pyafipws_mode_cert
+        vat_numbers = set(vat_numbers)
+        padrons = {}
+        if not force:
+            padrons = PadronCache.get_padrons(vat_numbers, mode)
+        missing = sorted(vat_numbers - set(padrons))
+        errors = {}
+        if not missing:
+            return padrons, errors
+        credentials = cls.get_ws_afip_credentials(company)
+        workers = Configuration(1).census_workers or 1
+        fetched = {}
+
+        def collect(results):
+            for vat_number, padron, error in results:
+                if isinstance(error, AFIPUnavailable):
+                    raise error
+                elif error:
+                    errors[vat_number] = str(error)
+                else:
+                    fetched[vat_number] = padron
+        try:
+            if use_asyncio:
+                from . import afip_async
+                collect(afip_async.fetch_padrons(credentials, missing,
+                        concurrency=workers, stats=stats))
+            else:
+                with ThreadPoolExecutor(max_workers=workers,
+                        thread_name_prefix='afip_padron') as executor:
+                    collect(cls._fetch_padrons(executor, missing, credentials,
+                            window=workers * 2, stats=stats))
+        finally:
+            PadronCache.set_padrons(fetched, mode)
+            AFIPPadron.set_padrons(fetched)
+            padrons.update(fetched)
+        return padrons, errors
+
+    @staticmethod
+    def query_ws_afip(credentials, vat_number):
+        """Query the AFIP padron for vat_number
+
+        It does not use the transaction so it can be run in worker threads.
+        """
+        with afip_call(), padron_client(credentials) as ws:
+            ws.Consultar(vat_number)
+            return Padron.from_ws(ws)
 
     def set_padron(self, padron, button_afip=True):
+        self.set_padrons([(self, padron)], button_afip=button_afip)
+
+    @classmethod
+    def set_padrons(cls, padrons, button_afip=True):
+        '''
+        Update the parties from the (party, padron) pairs.
+
+        The changes are computed in memory and written with one write of the
+        parties, one write of the invoice addresses and one create of the
+        fiscal addresses.
+        The invoice address is updated in place when AFIP returns the same
+        street and replaced only when the street changed.
+        '''
+        pool = Pool()
+        Address = pool.get('party.address')
+        AFIPActivity = pool.get('afip.activity')
+        Configuration = pool.get('party.configuration')
+        config = Configuration(1)
+
+        padrons = list(padrons)
+        now = datetime.datetime.now()
+        activities = None
+        if button_afip:
+            activities = AFIPActivity.get_activities(
+                activity_code(a)
+                for _, padron in padrons for a in padron.actividades[:2])
+        to_write = defaultdict(list)
+        for party, padron in padrons:
+            values = party.get_padron_values(padron, button_afip=button_afip,
+                activities=activities)
+            values.update(
+                party.get_afip_sync_values(padron, now=now, config=config))
+            to_write[tuple(sorted(values.items()))].append(party)
+
+        if button_afip:
+            country = cls.get_afip_country()
+            invoice_addresses = cls.get_invoice_addresses(
+                [p for p, _ in padrons])
+            address_args, to_deactivate, to_create = [], [], []
+            for party, padron in padrons:
+                address = invoice_addresses[party.id]
+                domicilio = next((d for d in padron.domicilios
+                        if d.get('tipoDomicilio') == 'FISCAL'), None)
+                if domicilio is None:
+                    if address:
+                        to_deactivate.append(address)
+                    continue
+                values = cls.get_fiscal_address_values(domicilio, country)
+                if address and (normalize_address(address.street)
+                        == normalize_address(values['street'])):
+                    # same place: only update the fields that changed
+                    changes = {n: v for n, v in values.items()
+                        if normalize_address(address_value(address, n))
+                        != normalize_address(v)}
+                    if changes:
+                        address_args.extend(([address], changes))
+                else:
+                    if address:
+                        to_deactivate.append(address)
+                    to_create.append({'party': party.id, **values})
+            if to_deactivate:
+                address_args.extend((to_deactivate, {'active': False}))
+            if address_args:
+                Address.write(*address_args)
+            if to_create:
+                Address.create(to_create)
+
+        args = []
+        for values, parties in to_write.items():
+            args.extend((parties, dict(values)))
+        if args:
+            cls.write(*args)
+
+    @classmethod
+    def get_fiscal_address_values(cls, domicilio, country):
+        'Return the address values of the FISCAL domicilio'
+        pool = Pool()
+        Address = pool.get('party.address')
+        subdivision = cls.get_afip_subdivision(
+            domicilio.get('idProvincia', 0))
+        values = {
+            'street': domicilio.get('direccion', ''),
+            'city': domicilio.get('localidad', ''),
+            'postal_code': domicilio.get('codPostal'),
+            'country': country.id if country else None,
+            'subdivision': subdivision.id if subdivision else None,
+            }
+        if 'invoice' in Address._fields:
+            values['invoice'] = True
+        return values
+
+    def get_padron_values(self, padron, button_afip=True, activities=None):
+        '''
+        Return the values of the party for the padron.
+
+        activities is a dictionary of the activity ids by code.
+        '''
+        pool = Pool()
+        AFIPActivity = pool.get('afip.activity')
+        values = {}
         if padron.tipo_persona == 'FISICA':
-            self.name = "%s, %s" % \
+            values['name'] = "%s, %s" % \
                 (padron.data.get('apellido'), padron.data.get('nombre'))
         else:
-            self.name = padron.data.get('razonSocial', '')
-        if padron.data.get('estadoClave') == 'ACTIVO':
-            self.active = True
-        else:
-            self.active = False
+            values['name'] = padron.data.get('razonSocial', '')
+        values['active'] = padron.data.get('estadoClave') == 'ACTIVO'
+
+        values['iva_condition'], values['ganancias_condition'] = (
+            self.get_padron_conditions(padron.impuestos, padron.monotributo))
+
+        if button_afip:
+            fecha_inscripcion = padron.data.get('fechaInscripcion', None)
+            if fecha_inscripcion:
+                values['start_activity_date'] = fecha_inscripcion.date()
+            codes = [activity_code(a) for a in padron.actividades[:2]]
+            if activities is None:
+                activities = AFIPActivity.get_activities(codes)
+            for name, code in zip(
+                    ['primary_activity', 'secondary_activity'], codes):
+                if code in activities:
+                    values[name] = activities[code]
+        return values
+
+    @classmethod
+    def get_invoice_addresses(cls, parties):
+        '''
+        Return a dictionary of the invoice address by party id.
 
-        mt = 'S' == padron.monotributo
-        impuestos = padron.impuestos
+        It is the address returned by address_get('invoice') but read for
+        all the parties with a single search.
+        '''
+        pool = Pool()
+        Address = pool.get('party.address')
+        addresses = defaultdict(list)
+        for sub_parties in grouped_slice(parties):
+            for address in Address.search([
+                        ('party', 'in', [p.id for p in sub_parties]),
+                        ('active', '=', True),
+                        ], order=[('sequence', 'ASC'), ('id', 'ASC')]):
+                addresses[address.party.id].append(address)
+        result = {}
+        for party in parties:
+            party_addresses = addresses.get(party.id)
+            if not party_addresses:
+                result[party.id] = None
+                continue
+            result[party.id] = next(
+                (a for a in party_addresses if getattr(a, 'invoice', None)),
+                party_addresses[0])
+        return result
+
+    @staticmethod
+    def get_padron_conditions(impuestos, monotributo):
+        'Return the IVA and ganancias conditions of the padron impuestos'
+        mt = 'S' == monotributo
         if 32 in impuestos:
-            self.iva_condition = 'exento'
+            iva_condition = 'exento'
         elif 34 in impuestos:
-            self.iva_condition = 'no_alcanzado'
+            iva_condition = 'no_alcanzado'
         else:
             if mt:
-                self.iva_condition = 'monotributo'
+                iva_condition = 'monotributo'
             elif 30 in impuestos:
-                self.iva_condition = 'responsable_inscripto'
+                iva_condition = 'responsable_inscripto'
             else:
-                self.iva_condition = 'consumidor_final'
+                iva_condition = 'consumidor_final'
 
-        self.ganancias_condition = 'ni'
+        ganancias_condition = 'ni'
         if any(item in [10, 11] for item in impuestos):
-            self.ganancias_condition = 'in'
+            ganancias_condition = 'in'
         elif 12 in impuestos:
-            self.ganancias_condition = 'ex'
+            ganancias_condition = 'ex'
+        return iva_condition, ganancias_condition
 
-        if button_afip:
-            fecha_inscripcion = padron.data.get('fechaInscripcion', None)
-            if fecha_inscripcion:
-                self.start_activity_date = fecha_inscripcion.date()
-            activ = padron.actividades
-            activ1 = str(activ[0]) if len(activ) >= 1 else ''
-            activ2 = str(activ[1]) if len(activ) >= 2 else ''
-            if activ1:
-                self.primary_activity_code = activ1.rjust(6, '0')
-            if activ2:
-                self.secondary_activity_code = activ2.rjust(6, '0')
-
-            Address = Pool().get('party.address')
-            address_ = self.address_get('invoice')
-            if address_:
-                address_.active = False
-                address_.save()
-            for domicilio in padron.domicilios:
-                if domicilio.get('tipoDomicilio') == 'FISCAL':
-                    address = Address()
-                    address.street = domicilio.get('direccion', '')
-                    address.city = domicilio.get('localidad', '')
-                    address.postal_code = domicilio.get('codPostal')
-                    address.country = self.get_afip_country()
-                    address.subdivision = self.get_afip_subdivision(
-                        domicilio.get('idProvincia', 0))
-                    address.party = self
-                    if domicilio.get('tipoDomicilio') == 'FISCAL':
-                        address.invoice = True
-                    address.save()
-        self.save()
+    @staticmethod
+    def get_padron_hash(padron):
+        'Return a digest of the padron data used to update the party'
+        payload = json.dumps([
+                padron.tipo_persona,
+                padron.data,
+                padron.monotributo,
+                padron.impuestos,
+                padron.actividades,
+                padron.domicilios,
+                ], sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def set_afip_sync(self, padron, now=None):
+        '''
+        Record the sync with the padron and schedule the next one.
+
+        The TTL doubles for each consecutive sync that got the same data.
+        '''
+        for name, value in self.get_afip_sync_values(padron, now=now).items():
+            setattr(self, name, value)
+
+    def get_afip_sync_values(self, padron, now=None, config=None):
+        'Return the values of set_afip_sync'
+        pool = Pool()
+        Configuration = pool.get('party.configuration')
+        if config is None:
+            config = Configuration(1)
+
+        if now is None:
+            now = datetime.datetime.now()
+        digest = self.get_padron_hash(padron)
+        if digest == self.afip_sync_hash:
+            unchanged = (self.afip_sync_unchanged or 0) + 1
+        else:
+            unchanged = 0
+        ttl = datetime.timedelta()
+        if config.census_ttl:
+            ttl = config.census_ttl * 2 ** min(unchanged, 16)
+        if config.census_max_ttl:
+            ttl = min(ttl, config.census_max_ttl)
+        return {
+            'afip_sync_hash': digest,
+            'afip_sync_date': now,
+            'afip_sync_next': now + ttl,
+            'afip_sync_unchanged': unchanged,
+            }
 
     @classmethod
     def get_afip_subdivision(cls, subdivision_code):
-        Subdivision = Pool().get('country.subdivision')
-        subdivision = PROVINCIAS[subdivision_code]
-        subdivision = Subdivision().search(
-            ['name', '=', subdivision]
-        )
-        if len(subdivision) > 0:
-            return subdivision[0]
-        else:
-            return ''
+        pool = Pool()
+        Country = pool.get('country.country')
+        Subdivision = pool.get('country.subdivision')
+        _, subdivision_ids = Country.get_afip_ids()
+        subdivision_id = subdivision_ids.get(subdivision_code)
+        if subdivision_id is not None:
+            return Subdivision(subdivision_id)
 
     @classmethod
     def get_afip_country(cls):
-        Country = Pool().get('country.country')
-        return Country().search(['code', '=', 'AR'])[0]
+        pool = Pool()
+        Country = pool.get('country.country')
+        country_id, _ = Country.get_afip_ids()
+        if country_id is not None:
+            return Country(country_id)
 
     # Button de AFIP
     @classmethod
@@ -471,26 +968,244 @@ class Party(metaclass=PoolMeta):
     def get_afip_data(cls, parties):
         pass
 
+    @classmethod
+    def import_padron_file(cls, path):
+        '''
+        Update iva_condition and ganancias_condition from the contributor
+        file of AFIP.
+
+        The zipped file is read as a stream and its records are matched
+        against the CUIT of the parties while they fill the padron mirror.
+        The conditions are updated with one query per combination of
+        conditions and only for the parties that change.
+        '''
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        Identifier = pool.get('party.identifier')
+        party = cls.__table__()
+        identifier = Identifier.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        cursor.execute(*identifier.select(
+                identifier.code, identifier.party,
+                where=identifier.type == 'ar_vat'))
+        parties = defaultdict(list)
+        for code, party_id in cursor:
+            parties[code].append(party_id)
+
+        stats = {'records': 0, 'matched': 0, 'updated': 0}
+        to_update = defaultdict(list)
+
+        def records():
+            for record in read_padron_file(path):
+                stats['records'] += 1
+                party_ids = parties.get(record['cuit'])
+                if party_ids:
+                    stats['matched'] += len(party_ids)
+                    conditions = cls.get_padron_conditions(
+                        *padron_file_impuestos(record))
+                    to_update[conditions].extend(party_ids)
+                yield record
+        stats['mirrored'] = AFIPPadron.import_records(records())
+
+        for (iva_condition, ganancias_condition), ids in to_update.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*party.update(
+                        [party.iva_condition, party.ganancias_condition,
+                            party.write_date, party.write_uid],
+                        [iva_condition, ganancias_condition,
+                            CurrentTimestamp(), transaction.user],
+                        where=reduce_ids(party.id, sub_ids)
+                        & ((Coalesce(party.iva_condition, '')
+                                != iva_condition)
+                            | (Coalesce(party.ganancias_condition, '')
+                                != ganancias_condition))))
+                stats['updated'] += max(cursor.rowcount, 0)
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                cache_cls = cache[cls.__name__]
+                for ids in to_update.values():
+                    for id_ in ids:
+                        cache_cls.pop(id_, None)
+        logger.info('AFIP padron file: %(records)s records, '
+            '%(matched)s parties matched, %(updated)s updated, '
+            '%(mirrored)s mirrored.', stats)
+        return stats
+
     @classmethod
     def import_census(cls, configs):
         '''
         Update iva_condition, active fields from afip.
+
+        Only the parties whose next sync date is due are queried by chunks
+        with get_ws_afip_list so the fresh answers of the padron cache are
+        used and the access ticket is renewed when it expires.
+        The results are applied in bulk and committed by chunk.
         '''
-        partys = cls.search([('vat_number', '!=', None)])
-        for party in partys:
+        pool = Pool()
+        Configuration = pool.get('party.configuration')
+        config = Configuration(1)
+
+        stats = {
+            'parties': 0, 'updated': 0, 'errors': 0, 'retries': 0,
+            'stopped': False,
+            }
+        start = time.monotonic()
+        partys = cls.search([
+                ('vat_number', '!=', None),
+                ['OR',
+                    ('afip_sync_next', '=', None),
+                    ('afip_sync_next', '<=', datetime.datetime.now()),
+                    ],
+                ])
+        stats['parties'] = len(partys)
+        # keep the batches of the workers in flight for each chunk
+        chunk = (config.census_workers or 1) * 2 * PADRON_LIST_LIMIT
+        transaction = Transaction()
+
+        def update(to_update):
+            # apply the padrons in bulk and fall back to one party at a time
+            # to isolate the parties that fail
+            try:
+                cls.set_padrons(
+                    [(party, p) for _, party, p in to_update],
+                    button_afip=False)
+                transaction.commit()
+                stats['updated'] += len(to_update)
+            except Exception:
+                transaction.rollback()
+                for vat_number, party, padron in to_update:
+                    try:
+                        party, = cls.browse([party.id])
+                        party.set_padron(padron, button_afip=False)
+                        transaction.commit()
+                        stats['updated'] += 1
+                    except Exception as e:
+                        transaction.rollback()
+                        stats['errors'] += 1
+                        logger.error('Could not update "%s" from AFIP: '
+                            '"%s".' % (vat_number, e))
+
+        for sub_partys in grouped_slice(partys, chunk):
+            sub_partys = [(p.vat_number, p) for p in sub_partys]
             try:
-                padron = cls.get_ws_afip(party.vat_number)
-                logging.info('got "%s" afip_ws_sr_padron_a5: "%s"' %
-                    (party.vat_number, padron.data))
-                if not padron.data:
-                    msg = ''.join([e['error'] for e in padron.errores])
-                    raise ValueError(msg)
-                party.set_padron(padron, button_afip=False)
-                Transaction().commit()
+                padrons, errors = cls.get_ws_afip_list(
+                    {v for v, _ in sub_partys},
+                    use_asyncio=config.census_asyncio, stats=stats)
+                transaction.commit()
+            except AFIPUnavailable as e:
+                transaction.commit()
+                stats['stopped'] = True
+                logger.error('AFIP is unavailable, stopping the census: '
+                    '"%s".' % e)
+                break
             except Exception as e:
-                msg = str(e)
-                logger.error('Could not retrieve "%s" msg AFIP: "%s".' %
-                    (party.vat_number, msg))
+                transaction.rollback()
+                stats['stopped'] = True
+                logger.error('Could not query AFIP, stopping the census: '
+                    '"%s".' % e)
+                break
+            to_update = []
+            for vat_number, party in sub_partys:
+                padron = padrons.get(vat_number)
+                if padron:
+                    logging.info('got "%s" afip_ws_sr_padron_a5: "%s"' %
+                        (vat_number, padron.data))
+                    to_update.append((vat_number, party, padron))
+                else:
+                    stats['errors'] += 1
+                    logger.error('Could not retrieve "%s" msg AFIP: "%s".' %
+                        (vat_number, errors.get(vat_number, '')))
+            for sub_update in grouped_slice(to_update, PADRON_LIST_LIMIT):
+                update(list(sub_update))
+
+        elapsed = time.monotonic() - start
+        done = stats['updated'] + stats['errors']
+        logger.info('AFIP census%(stopped)s: %(parties)s parties, '
+            '%(updated)s updated, %(errors)s errors, %(skipped)s skipped, '
+            '%(retries)s retried batches in %(elapsed).1fs '
+            '(%(rate).2f parties/s).', {
+                **stats,
+                'stopped': ' stopped early' if stats['stopped'] else '',
+                'skipped': stats['parties'] - done,
+                'elapsed': elapsed,
+                'rate': done / elapsed if elapsed else 0,
+                })
+        return stats
+
+    @classmethod
+    def _fetch_padrons(cls, executor, vat_numbers, credentials, window,
+            stats=None):
+        '''
+        Yield (vat_number, padron, exception) as the padron lookups complete.
+
+        The VAT numbers are queried by batches of getPersonaList keeping at
+        most window batches in flight. The batches that failed because AFIP
+        throttled or timed out are queued again with an exponential backoff.
+        '''
+        retries = config_.getint('party_ar', 'afip_retries', default=3)
+        retry_delay = config_.getfloat(
+            'party_ar', 'afip_retry_delay', default=10)
+        if stats is None:
+            stats = {}
+        stats.setdefault('retries', 0)
+
+        batches = deque(vat_numbers[i:i + PADRON_LIST_LIMIT]
+            for i in range(0, len(vat_numbers), PADRON_LIST_LIMIT))
+        # heap of (ready time, sequence, attempt, batch)
+        queue = []
+        sequence = count()
+        pending = {}
+
+        def submit():
+            while len(pending) < window:
+                if queue and queue[0][0] <= time.monotonic():
+                    _, _, attempt, batch = heappop(queue)
+                elif batches:
+                    attempt, batch = 0, batches.popleft()
+                else:
+                    return
+                future = executor.submit(query_padron_list, credentials,
+                    batch)
+                pending[future] = (attempt, batch)
+
+        submit()
+        while pending or queue:
+            timeout = None
+            if queue:
+                timeout = max(queue[0][0] - time.monotonic(), 0)
+            if pending:
+                done, _ = wait(
+                    pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
+                done = set()
+            for future in done:
+                attempt, batch = pending.pop(future)
+                try:
+                    padrons, errors = future.result()
+                except Exception as e:
+                    if is_transient_error(e) and attempt < retries:
+                        stats['retries'] += 1
+                        logger.warning('Retrying %s CUITs in %ss: "%s".',
+                            len(batch), retry_delay * 2 ** attempt, e)
+                        heappush(queue, (
+                                time.monotonic() + retry_delay * 2 ** attempt,
+                                next(sequence), attempt + 1, batch))
+                    else:
+                        for vat_number in batch:
+                            yield vat_number, None, e
+                    continue
+                for vat_number in batch:
+                    padron = padrons.get(vat_number)
+                    if padron:
+                        yield vat_number, padron, None
+                    else:
+                        yield vat_number, None, ValueError(
+                            errors.get(vat_number, ''))
+            submit()
 
     @classmethod
     def import_cron_afip(cls, args=None):
@@ -508,6 +1223,13 @@ class PartyIdentifier(metaclass=PoolMeta):
     afip_country = fields.Many2One('afip.country', 'Country',
         states={'invisible': ~Equal(Eval('type'), 'ar_foreign')})
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.type, Index.Equality()), (t.code, Index.Equality())))
+
     @classmethod
     def __register__(cls, module_name):
         cursor = Transaction().connection.cursor()
@@ -591,92 +1313,26 @@ class PartyIdentifier(metaclass=PoolMeta):
                         vat_country=vat_country, party=party_id))
             cls.save(identifiers)
 
-        # map ISO country code to AFIP destination country code:
-        pais_dst_cmp = {
-            'bf': 101, 'dz': 102, 'bw': 103, 'bi': 104, 'cm': 105,
-            'cf': 107, 'cg': 108, 'cd': 109, 'ci': 110, 'td': 111,
-            'bj': 112, 'eg': 113, 'ga': 115, 'gm': 116, 'gh': 117,
-            'gn': 118, 'gq': 119, 'ke': 120, 'ls': 121, 'lr': 122,
-            'ly': 123, 'mg': 124, 'mw': 125, 'ml': 126, 'ma': 127,
-            'mu': 128, 'mr': 129, 'ne': 130, 'ng': 131, 'zw': 132,
-            'rw': 133, 'sn': 134, 'sl': 135, 'so': 136, 'sz': 137,
-            'sd': 138, 'tz': 139, 'tg': 140, 'tn': 141, 'ug': 142,
-            'zm': 144, 'ao': 149, 'cv': 150, 'mz': 151, 'sc': 152,
-            'dj': 153, 'km': 155, 'gw': 156, 'st': 157, 'na': 158,
-            'za': 159, 'er': 160, 'et': 161, 'ar': 200, 'bb': 201,
-            'bo': 202, 'br': 203, 'ca': 204, 'co': 205, 'cr': 206,
-            'cu': 207, 'cl': 208, 'do': 209, 'ec': 210, 'sv': 211,
-            'us': 212, 'gt': 213, 'gy': 214, 'ht': 215, 'hn': 216,
-            'jm': 217, 'mx': 218, 'ni': 219, 'pa': 220, 'py': 221,
-            'pe': 222, 'pr': 223, 'tt': 224, 'uy': 225, 've': 226,
-            'sr': 232, 'dm': 233, 'lc': 234, 'vc': 235, 'bz': 236,
-            'ag': 237, 'kn': 238, 'bs': 239, 'gd': 240, 'af': 301,
-            'sa': 302, 'bh': 303, 'mm': 304, 'bt': 305, 'kh': 306,
-            'lk': 307, 'kp': 308, 'kr': 309, 'cn': 310, 'ph': 312,
-            'tw': 313, 'in': 315, 'id': 316, 'iq': 317, 'ir': 318,
-            'il': 319, 'jp': 320, 'jo': 321, 'qa': 322, 'kw': 323,
-            'la': 324, 'lb': 325, 'my': 326, 'mv': 327, 'om': 328,
-            'mn': 329, 'np': 330, 'ae': 331, 'pk': 332, 'sg': 333,
-            'sy': 334, 'th': 335, 'vn': 337, 'hk': 341, 'mo': 344,
-            'bd': 345, 'bn': 346, 'ye': 348, 'am': 349, 'az': 350,
-            'ge': 351, 'kz': 352, 'kg': 353, 'tj': 354, 'tm': 355,
-            'uz': 356, 'ps': 357, 'al': 401, 'ad': 404, 'at': 405,
-            'be': 406, 'bg': 407, 'dk': 409, 'es': 410, 'fi': 411,
-            'fr': 412, 'gr': 413, 'hu': 414, 'ie': 415, 'is': 416,
-            'it': 417, 'li': 418, 'lu': 419, 'mt': 420, 'mc': 421,
-            'no': 422, 'nl': 423, 'pl': 424, 'pt': 425, 'gb': 426,
-            'ro': 427, 'sm': 428, 'se': 429, 'ch': 430, 'va': 431,
-            'cy': 435, 'tr': 436, 'de': 438, 'by': 439, 'ee': 440,
-            'lv': 441, 'lt': 442, 'md': 443, 'ru': 444, 'ua': 445,
-            'ba': 446, 'hr': 447, 'sk': 448, 'si': 449, 'mk': 450,
-            'cz': 451, 'me': 453, 'rs': 454, 'au': 501, 'nr': 503,
-            'nz': 504, 'vu': 505, 'ws': 506, 'fj': 512, 'pg': 513,
-            'ki': 514, 'fm': 515, 'pw': 516, 'tv': 517, 'sb': 518,
-            'to': 519, 'mh': 520, 'mp': 521,
-            }
-
         # Migration legacy: country -> afip_country
         if table_h.column_exist('country'):
-            cursor.execute(*sql_table.select(
-                    sql_table.id, sql_table.country))
-            for id, vat_country_id in cursor.fetchall():
-                if vat_country_id:
-                    cursor.execute(*country_table.select(country_table.code,
-                            where=(country_table.id == vat_country_id)))
-                    row = cursor.fetchone()
-                    if not row:
-                        continue
-                    dst = pais_dst_cmp.get(row[0].lower(), None)
-                    if not dst:
-                        continue
-                    cursor.execute(*afip_country.select(afip_country.id,
-                            where=(afip_country.code == str(dst))))
-                    row = cursor.fetchone()
-                    if not row:
-                        continue
-                    cursor.execute(*sql_table.update(
-                        [sql_table.afip_country], [row[0]],
-                        where=sql_table.id == id))
+            mapping = pais_dst_cmp_values()
+            cursor.execute(*sql_table.update(
+                    [sql_table.afip_country], [afip_country.id],
+                    from_=[country_table, mapping, afip_country],
+                    where=(sql_table.country == country_table.id)
+                    & (Lower(country_table.code) == mapping.column1)
+                    & (afip_country.code == mapping.column2)))
             table_h.drop_column('country')
 
         # Migration legacy: vat_country -> afip_country
         if table_h.column_exist('vat_country'):
-            cursor.execute(*sql_table.select(
-                sql_table.id, sql_table.vat_country,
-                where=(sql_table.type == 'ar_foreign')))
-            for id, vat_country in cursor.fetchall():
-                if vat_country != '':
-                    dst = pais_dst_cmp.get(vat_country.lower(), None)
-                    if not dst:
-                        continue
-                    cursor.execute(*afip_country.select(afip_country.id,
-                            where=(afip_country.code == str(dst))))
-                    row = cursor.fetchone()
-                    if not row:
-                        continue
-                    cursor.execute(*sql_table.update(
-                        [sql_table.afip_country], [row[0]],
-                        where=sql_table.id == id))
+            mapping = pais_dst_cmp_values()
+            cursor.execute(*sql_table.update(
+                    [sql_table.afip_country], [afip_country.id],
+                    from_=[mapping, afip_country],
+                    where=(sql_table.type == 'ar_foreign')
+                    & (Lower(sql_table.vat_country) == mapping.column1)
+                    & (afip_country.code == mapping.column2)))
             table_h.drop_column('vat_country')
 
     @fields.depends('type', 'code')
@@ -692,34 +1348,50 @@ class PartyIdentifier(metaclass=PoolMeta):
     @classmethod
     def validate(cls, identifiers):
         super().validate(identifiers)
+        # the CUIT are checked in bulk by check_vat_numbers
         for identifier in identifiers:
-            identifier.check_code()
+            if identifier.type != 'ar_vat':
+                identifier.check_code()
+        cls.check_vat_numbers(identifiers)
+        cls.check_foreign_vats(identifiers)
 
-    def check_code(self):
-        super().check_code()
-        if self.type == 'ar_vat':
-            if not cuit.is_valid(self.code):
-                raise InvalidIdentifierCode(
-                    gettext('party.msg_invalid_vat_number',
-                    code=self.code, party=self.party.rec_name))
-        elif self.type == 'ar_foreign':
-            self.check_foreign_vat()
+    @classmethod
+    def check_vat_numbers(cls, identifiers):
+        'Check the CUIT of the identifiers in one pass'
+        identifiers = [i for i in identifiers if i.type == 'ar_vat']
+        report = check_cuits([i.code for i in identifiers])
+        if report:
+            row, code, _ = report[0]
+            raise InvalidIdentifierCode(
+                gettext('party.msg_invalid_code',
+                    type=identifiers[row].type_string,
+                    code=code, party=identifiers[row].party.rec_name))
 
     def check_foreign_vat(self):
-        AFIPVatCountry = Pool().get('party.afip.vat.country')
+        self.check_foreign_vats([self])
 
-        if not self.afip_country:
-            return
+    @classmethod
+    def check_foreign_vats(cls, identifiers):
+        '''
+        Check the foreign identifiers are registered for their AFIP country
 
-        vat_numbers = AFIPVatCountry.search([
-            ('afip_country.code', '=', self.afip_country.code),
-            ('vat_number', '=', self.code),
-            ])
+        The registered VAT numbers are read once for all the identifiers.
+        '''
+        AFIPVatCountry = Pool().get('party.afip.vat.country')
 
-        if not vat_numbers:
-            raise InvalidIdentifierCode(
-                gettext('party.msg_invalid_vat_number',
-                code=self.code, party=self.party.name))
+        identifiers = [i for i in identifiers
+            if i.type == 'ar_foreign' and i.afip_country]
+        if not identifiers:
+            return
+        vat_numbers = AFIPVatCountry.get_vat_numbers()
+        for identifier in identifiers:
+            if ((identifier.afip_country.id, identifier.code)
+                    not in vat_numbers):
+                raise InvalidIdentifierCode(
+                    gettext('party.msg_invalid_code',
+                        type=identifier.type_string,
+                        code=identifier.code,
+                        party=identifier.party.rec_name))
 
 
 class GetAFIPDataStart(ModelView):
@@ -732,10 +1404,10 @@ class GetAFIPDataStart(ModelView):
     codigo_postal = fields.Char('Código Postal', readonly=True)
     fecha_inscripcion = fields.Date('Fecha de Inscripción', readonly=True)
     subdivision_code = fields.Integer('Provincia', readonly=True)
-    primary_activity_code = fields.Selection(CODES, 'Actividad primaria',
-        readonly=True)
-    secondary_activity_code = fields.Selection(CODES, 'Actividad secundaria',
+    primary_activity = fields.Many2One('afip.activity', 'Actividad primaria',
         readonly=True)
+    secondary_activity = fields.Many2One('afip.activity',
+        'Actividad secundaria', readonly=True)
     estado = fields.Char('Estado', readonly=True)
 
 
@@ -747,19 +1419,16 @@ class GetAFIPData(Wizard):
         'party.get_afip_data.start',
         'party_ar.get_afip_data_start_view', [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Refresh', 'refresh', 'tryton-refresh'),
             Button('Ok', 'update_party', 'tryton-ok', default=True),
         ])
+    refresh = StateTransition()
     update_party = StateTransition()
 
-    def default_start(self, fields):
+    def get_padron(self, party, force=False):
         Party = Pool().get('party.party')
-
-        party = Party(Transaction().context['active_id'])
-        if not party:
-            return {}
-
         try:
-            padron = Party.get_ws_afip(party.vat_number)
+            padron = Party.get_afip_padron(party.vat_number, force=force)
             if not padron.data:
                 msg = ''.join([e['error'] for e in padron.errores])
                 raise ValueError(msg)
@@ -771,6 +1440,18 @@ class GetAFIPData(Wizard):
                 gettext('party_ar.msg_vat_number_not_found',
                 party=party.rec_name,
                 error=msg))
+        return padron
+
+    def default_start(self, fields):
+        pool = Pool()
+        Party = pool.get('party.party')
+        AFIPActivity = pool.get('afip.activity')
+
+        party = Party(Transaction().context['active_id'])
+        if not party:
+            return {}
+
+        padron = self.get_padron(party)
         res = {}
         activ = padron.actividades
         for domicilio in padron.domicilios:
@@ -781,12 +1462,9 @@ class GetAFIPData(Wizard):
                 res['subdivision_code'] = domicilio.get("idProvincia", 0)
                 res['codigo_postal'] = domicilio.get("codPostal")
 
-        activ1 = str(activ[0]) if len(activ) >= 1 else ''
-        activ2 = str(activ[1]) if len(activ) >= 2 else ''
-        if activ1:
-            activ1 = activ1.rjust(6, '0')
-        if activ2:
-            activ2 = activ2.rjust(6, '0')
+        codes = [activity_code(a) for a in activ[:2]]
+        activities = AFIPActivity.get_activities(codes)
+        codes += [None] * (2 - len(codes))
 
         if padron.tipo_persona == 'FISICA':
             res['name'] = "%s, %s" % (
@@ -796,18 +1474,25 @@ class GetAFIPData(Wizard):
 
         res.update({
             'fecha_inscripcion': padron.data.get('fechaInscripcion', None),
-            'primary_activity_code': activ1,
-            'secondary_activity_code': activ2,
+            'primary_activity': activities.get(codes[0]),
+            'secondary_activity': activities.get(codes[1]),
             'estado': padron.data.get('estadoClave', ''),
             })
         return res
 
+    def transition_refresh(self):
+        # Consultamos AFIP aunque el espejo del padrón esté vigente
+        Party = Pool().get('party.party')
+        party = Party(Transaction().context['active_id'])
+        self.get_padron(party, force=True)
+        return 'start'
+
     def transition_update_party(self):
         # Actualizamos la party con la data que vino de AFIP
         Party = Pool().get('party.party')
         party = Party(Transaction().context.get('active_id'))
         try:
-            padron = Party.get_ws_afip(party.vat_number)
+            padron = Party.get_afip_padron(party.vat_number)
             logging.info('got "%s" afip_ws_sr_padron_a5: "%s"' %
                 (party.vat_number, padron.data))
             if not padron.data:
@@ -829,4 +1514,63 @@ class Cron(metaclass=PoolMeta):
         super().__setup__()
         cls.method.selection.extend([
                 ('party.party|import_cron_afip', "Import AFIP Census"),
+                ('afip.padron.cache|purge_expired',
+                    "Purge AFIP Padron Cache"),
+                ('afip.padron|purge_expired', "Purge AFIP Padron Mirror"),
                 ])
+
+
+class CheckVatNumbersStart(ModelView):
+    'Check VAT Numbers Start'
+    __name__ = 'party.check_vat_numbers.start'
+
+    file_ = fields.Binary('File', required=True,
+        help='A text file with a CUIT in the first column of each line.')
+
+
+class CheckVatNumbersResult(ModelView):
+    'Check VAT Numbers Result'
+    __name__ = 'party.check_vat_numbers.result'
+
+    total = fields.Integer('Total', readonly=True)
+    invalid = fields.Integer('Invalid', readonly=True)
+    report = fields.Text('Report', readonly=True)
+
+
+class CheckVatNumbers(Wizard):
+    'Check VAT Numbers'
+    __name__ = 'party.check_vat_numbers'
+
+    start = StateView(
+        'party.check_vat_numbers.start',
+        'party_ar.check_vat_numbers_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Check', 'check', 'tryton-ok', default=True),
+            ])
+    check = StateTransition()
+    result = StateView(
+        'party.check_vat_numbers.result',
+        'party_ar.check_vat_numbers_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_check(self):
+        data = self.start.file_
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        codes = [re.split(r'[,;\t]', line, 1)[0].strip()
+            for line in data.splitlines()]
+        report = check_cuits(codes)
+        self.result.total = len(codes)
+        self.result.invalid = len(report)
+        self.result.report = '\n'.join(
+            '%s: %s (%s)' % (row + 1, code, error)
+            for row, code, error in report)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'total': self.result.total,
+            'invalid': self.result.invalid,
+            'report': self.result.report,
+            }
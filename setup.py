@@ -87,7 +87,8 @@ setup(name='%s_%s' % (PREFIX, MODULE),
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', []) + [
             'tryton.cfg', 'view/*.xml', 'locale/*.po', 'locale/override/*.po',
-            'data/*.xml', 'tests/*.rst', 'tests/*.key', 'tests/*.crt']),
+            'data/*.xml', 'doc/*.txt', 'tests/*.rst', 'tests/*.key',
+            'tests/*.crt']),
         },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -115,6 +116,8 @@ setup(name='%s_%s' % (PREFIX, MODULE),
     python_requires='>=3.8',
     install_requires=requires,
     extras_require={
+        'async': ['httpx'],
+        'numpy': ['numpy'],
         'test': tests_require,
         },
     zip_safe=False,
@@ -0,0 +1,494 @@
+# This file is part of the party_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Benchmarks of the party_ar module.
+
+They run against a scratch database where party_ar is installed (except
+install), for example::
+
+    trytond-admin -c trytond.conf -d bench --all
+    python -m trytond.modules.party_ar.tests.benchmark \\
+        -c trytond.conf -d bench census --rows 10000 -o bench.json
+
+The AFIP padron is replaced by a fake WSSrPadronA5 answering without network
+and the access tickets are stored in the process, so no certificate is
+needed.
+The results are printed as JSON and appended as a line to the output file to
+compare them between versions.
+'''
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+import types
+import uuid
+from itertools import islice
+
+from sql import Column, Null
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+BATCH = 1000
+# default number of rows by benchmark
+ROWS = {
+    'authenticate': 100000,
+    'census': 10000,
+    'foreign_vat': 10000,
+    'install': 0,
+    'migration': 100000,
+    'set_padron': 1000,
+    'update': 0,
+    'vat_number': 100000,
+    }
+SAMPLES = 1000
+WSAA_URL = 'https://wsaahomo.afip.gov.ar/ws/services/LoginCms?wsdl'
+
+
+def batched(iterable, size=BATCH):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def timed(func, *args, **kwargs):
+    'Return the seconds taken by the call'
+    start = time.monotonic()
+    func(*args, **kwargs)
+    return time.monotonic() - start
+
+
+def cuit(number):
+    'Return a valid CUIT for the number'
+    from trytond.modules.party_ar.validation import (
+        CUIT_WEIGHTS, CUIT_CHECK_DIGITS)
+    number = '20%08d' % (number % 10 ** 8)
+    total = sum(w * int(n) for w, n in zip(CUIT_WEIGHTS, number))
+    return number + CUIT_CHECK_DIGITS[total % 11]
+
+
+def fake_persona(vat_number):
+    'Return a persona of the padron A5 for the VAT number'
+    return {
+        'datosGenerales': {
+            'idPersona': int(vat_number),
+            'tipoPersona': 'FISICA',
+            'razonSocial': 'Party %s' % vat_number,
+            'estadoClave': 'ACTIVO',
+            'domicilioFiscal': {
+                'direccion': 'Calle %s' % vat_number[-4:],
+                'localidad': 'La Plata',
+                'codPostal': '1900',
+                'idProvincia': 1,
+                'tipoDomicilio': 'FISCAL',
+                },
+            },
+        'datosRegimenGeneral': {
+            'impuesto': [{'idImpuesto': 30}, {'idImpuesto': 10}],
+            'actividad': [{'idActividad': 620100, 'orden': 1}],
+            },
+        }
+
+
+class FakeSoapClient(object):
+
+    def getPersonaList_v2(self, sign, token, cuitRepresentada, idPersona):
+        return {
+            'personaListReturn': {
+                'persona': [fake_persona(str(v)) for v in idPersona],
+                },
+            }
+
+
+class FakeWSSrPadronA5(object):
+    'WSSrPadronA5 answering from fake_persona'
+
+    def __init__(self):
+        self.client = FakeSoapClient()
+        self.LanzarExcepciones = False
+        self.Token = self.Sign = self.Cuit = None
+
+    def Conectar(self, wsdl=None, cache=None, cacert=None):
+        return True
+
+    def SetTicketAcceso(self, ta):
+        self.Token, self.Sign = 'token', 'sign'
+        return True
+
+    def Consultar(self, id_persona):
+        from trytond.modules.party_ar.afip import Padron
+        padron = Padron.from_persona(fake_persona(str(id_persona)))
+        for name in Padron.__slots__:
+            setattr(self, name, getattr(padron, name))
+        return True
+
+
+def install_fake_padron():
+    'Replace pyafipws.ws_sr_padron by the fake padron'
+    module = types.ModuleType('pyafipws.ws_sr_padron')
+    module.WSSrPadronA5 = FakeWSSrPadronA5
+    sys.modules.setdefault('pyafipws', types.ModuleType('pyafipws'))
+    sys.modules['pyafipws.ws_sr_padron'] = module
+
+
+def set_ticket(service, crt, key, wsdl=WSAA_URL):
+    'Store a valid access ticket in the process for the service'
+    from trytond.modules.party_ar.afip import ticket_fingerprint
+    PyAfipWsWrapper = Pool().get('afip.wrapper')
+    expiration = (
+        datetime.datetime.now(datetime.timezone.utc)
+        + datetime.timedelta(hours=5))
+    PyAfipWsWrapper._tickets[
+        (service, ticket_fingerprint(service, crt, key), wsdl)] = (
+        PyAfipWsWrapper._new_ticket('<loginTicketResponse/>', expiration))
+
+
+def setup_company():
+    'Create a company in homologacion using the tickets of the process'
+    from trytond.modules.company.tests import create_company
+
+    for service in ['wsfe', 'ws_sr_constancia_inscripcion']:
+        set_ticket(service, 'certificate', 'key')
+    company = create_company()
+    company.pyafipws_certificate = 'certificate'
+    company.pyafipws_private_key = 'key'
+    company.pyafipws_mode_cert = 'homologacion'
+    company.save()
+    return company
+
+
+def update_module(options, *args):
+    'Return the seconds taken by trytond-admin to update party_ar'
+    command = [
+        options.admin, '-d', options.database, '-u', 'party_ar', *args]
+    if options.config:
+        command[1:1] = ['-c', options.config]
+    start = time.monotonic()
+    subprocess.run(command, check=True)
+    return time.monotonic() - start
+
+
+def insert_parties(names, values):
+    '''
+    Insert a party by row of values for the column names by SQL
+
+    The ids are read back by the generated codes as SQLite does not support
+    RETURNING with table aliases. Return the ids in the order of values.
+    '''
+    Party = Pool().get('party.party')
+    cursor = Transaction().connection.cursor()
+    party = Party.__table__()
+
+    codes = [uuid.uuid4().hex for _ in values]
+    cursor.execute(*party.insert(
+            [party.name, party.code, party.active]
+            + [Column(party, n) for n in names],
+            [['Party %s' % c, c, True] + v for c, v in zip(codes, values)]))
+    cursor.execute(*party.select(party.id, party.code,
+            where=party.code.in_(codes)))
+    ids = {c: i for i, c in cursor}
+    return [ids[c] for c in codes]
+
+
+def create_parties(rows, type='ar_vat', code=cuit):
+    '''
+    Create rows parties with an identifier of type by SQL
+
+    The code of the identifier is computed from the id of the party.
+    Return the ids of the parties.
+    '''
+    Identifier = Pool().get('party.identifier')
+    cursor = Transaction().connection.cursor()
+    identifier = Identifier.__table__()
+
+    party_ids = []
+    for numbers in batched(range(rows)):
+        ids = insert_parties(
+            ['iva_condition'], [['responsable_inscripto']] * len(numbers))
+        cursor.execute(*identifier.insert(
+                [identifier.party, identifier.type, identifier.code,
+                    identifier.active],
+                [[p, type, code(p), True] for p in ids]))
+        party_ids.extend(ids)
+    return party_ids
+
+
+def fill_legacy_identifiers(rows):
+    '''
+    Create rows parties with a foreign identifier and as many AFIP VAT
+    countries in the columns used before afip_country.
+    '''
+    from trytond.modules.party_ar.party import PAIS_DST_CMP
+
+    pool = Pool()
+    Country = pool.get('country.country')
+    Identifier = pool.get('party.identifier')
+    AFIPVatCountry = pool.get('party.afip.vat.country')
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+
+    countries = Country.search([])
+    codes = {c.code.lower() for c in countries}
+    Country.create([{'name': code.upper(), 'code': code.upper()}
+            for code in PAIS_DST_CMP if code not in codes])
+    country_ids = [c.id for c in Country.search([])]
+
+    table_h = Identifier.__table_handler__()
+    table_h.add_column('country', 'INTEGER')
+    table_h.add_column('vat_country', 'VARCHAR')
+    AFIPVatCountry.__table_handler__().add_column('vat_country', 'INTEGER')
+
+    identifier = Identifier.__table__()
+    vat_country = AFIPVatCountry.__table__()
+    iso_codes = sorted(PAIS_DST_CMP)
+    for numbers in batched(range(rows)):
+        party_ids = insert_parties([], [[]] * len(numbers))
+        cursor.execute(*identifier.insert(
+                [identifier.party, identifier.type, identifier.code,
+                    identifier.active, identifier.country,
+                    identifier.vat_country],
+                [[p, 'ar_foreign', '55%09d' % n, True,
+                        country_ids[n % len(country_ids)],
+                        iso_codes[n % len(iso_codes)]]
+                    for p, n in zip(party_ids, numbers)]))
+        cursor.execute(*vat_country.insert(
+                [vat_country.vat_number, vat_country.type_code,
+                    vat_country.vat_country],
+                [['55%09d' % n, '0', country_ids[n % len(country_ids)]]
+                    for n in numbers]))
+    transaction.commit()
+
+
+def bench_install(options):
+    '''
+    Time the activation of the module
+
+    The database must be initialized without party_ar, for example with
+    trytond-admin -d DB --all.
+    '''
+    return {
+        'install': update_module(options, '--activate-dependencies'),
+        }
+
+
+def bench_update(options):
+    'Time the update of the module with and without the activities loaded'
+    with Transaction().start(options.database, 0) as transaction:
+        pool = Pool()
+        activity = pool.get('afip.activity').__table__()
+        party = pool.get('party.party').__table__()
+        cursor = transaction.connection.cursor()
+        # the activities used by parties are kept because of the restrict
+        cursor.execute(*activity.delete(
+                where=~activity.id.in_(party.select(
+                        party.primary_activity,
+                        where=party.primary_activity != Null))
+                & ~activity.id.in_(party.select(
+                        party.secondary_activity,
+                        where=party.secondary_activity != Null))))
+        transaction.commit()
+    return {
+        'load': update_module(options),
+        'update': update_module(options),
+        }
+
+
+def bench_migration(options):
+    'Time the update of the module with the legacy country columns filled'
+    with Transaction().start(options.database, 0):
+        start = time.monotonic()
+        fill_legacy_identifiers(options.rows)
+        fill = time.monotonic() - start
+    return {
+        'fill': fill,
+        'update': update_module(options),
+        }
+
+
+def bench_vat_number(options):
+    'Time the reading and the searches of vat_number'
+    with Transaction().start(options.database, 0) as transaction:
+        Party = Pool().get('party.party')
+        party_ids = create_parties(options.rows)
+        samples = random.sample(party_ids, min(SAMPLES, len(party_ids)))
+
+        def read():
+            for ids in batched(party_ids):
+                Party.read(ids, ['vat_number'])
+
+        def search():
+            for party_id in samples:
+                Party.search([('vat_number', '=', cuit(party_id))])
+
+        results = {
+            'read': timed(read),
+            'search': timed(search),
+            'search_in': timed(Party.search,
+                [('vat_number', 'in', [cuit(p) for p in samples])]),
+            }
+        transaction.rollback()
+    return results
+
+
+def bench_set_padron(options):
+    'Time set_padron by party and set_padrons in bulk'
+    from trytond.modules.party_ar.afip import Padron
+    with Transaction().start(options.database, 0) as transaction:
+        Party = Pool().get('party.party')
+        setup_company()
+
+        def pairs():
+            parties = Party.browse(create_parties(options.rows))
+            return [(p, Padron.from_persona(fake_persona(p.vat_number)))
+                for p in parties]
+
+        def set_padron(pairs):
+            for party, padron in pairs:
+                party.set_padron(padron)
+
+        results = {
+            'set_padron': timed(set_padron, pairs()),
+            'set_padrons': timed(Party.set_padrons, pairs()),
+            }
+        transaction.rollback()
+    return results
+
+
+def bench_census(options):
+    '''
+    Time import_census of new parties
+
+    The parties are committed with their synchronisation dates.
+    '''
+    with Transaction().start(options.database, 0) as transaction:
+        Party = Pool().get('party.party')
+        company = setup_company()
+        create_parties(options.rows)
+        transaction.commit()
+        with transaction.set_context(company=company.id):
+            start = time.monotonic()
+            stats = Party.import_census(None)
+            elapsed = time.monotonic() - start
+    return {
+        'census': elapsed,
+        'updated': stats['updated'],
+        'errors': stats['errors'],
+        }
+
+
+def bench_foreign_vat(options):
+    'Time the validation of foreign identifiers against the AFIP countries'
+    with Transaction().start(options.database, 0) as transaction:
+        pool = Pool()
+        AFIPCountry = pool.get('afip.country')
+        AFIPVatCountry = pool.get('party.afip.vat.country')
+        Identifier = pool.get('party.identifier')
+        cursor = transaction.connection.cursor()
+        vat_country = AFIPVatCountry.__table__()
+
+        country, = AFIPCountry.create([{'code': '999', 'name': 'Benchmark'}])
+        party_ids = create_parties(options.rows)
+        for ids in batched(party_ids):
+            cursor.execute(*vat_country.insert(
+                    [vat_country.vat_number, vat_country.type_code,
+                        vat_country.afip_country],
+                    [['55%09d' % p, '0', country.id] for p in ids]))
+        AFIPVatCountry._vat_numbers_cache.clear()
+        identifiers = Identifier.search([('party', 'in', party_ids)])
+        for identifier in identifiers:
+            identifier.type = 'ar_foreign'
+            identifier.code = '55%09d' % identifier.party.id
+            identifier.afip_country = country
+
+        results = {
+            'validate': timed(Identifier.save, identifiers),
+            }
+        transaction.rollback()
+    return results
+
+
+def bench_authenticate(options):
+    'Time the access tickets read from the process'
+    with Transaction().start(options.database, 0) as transaction:
+        PyAfipWsWrapper = Pool().get('afip.wrapper')
+        set_ticket('wsfe', 'certificate', 'key')
+
+        def authenticate():
+            for _ in range(options.rows):
+                PyAfipWsWrapper.authenticate(
+                    'wsfe', 'certificate', 'key', wsdl=WSAA_URL)
+
+        results = {
+            'authenticate': timed(authenticate),
+            }
+        transaction.rollback()
+    return results
+
+
+BENCHMARKS = {
+    'authenticate': bench_authenticate,
+    'census': bench_census,
+    'foreign_vat': bench_foreign_vat,
+    'install': bench_install,
+    'migration': bench_migration,
+    'set_padron': bench_set_padron,
+    'update': bench_update,
+    'vat_number': bench_vat_number,
+    }
+
+
+def get_version(database):
+    'Return the version of party_ar activated in the database'
+    with Transaction().start(database, 0, readonly=True):
+        Module = Pool().get('ir.module')
+        modules = Module.search([('name', '=', 'party_ar')])
+        return modules[0].version if modules else None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-o', '--output', dest='output',
+        help='append the result to the file')
+    parser.add_argument('--rows', type=int)
+    parser.add_argument('--admin', default=shutil.which('trytond-admin',
+            path=os.pathsep.join([
+                    os.path.dirname(sys.executable),
+                    os.environ.get('PATH', '')])),
+        help='the trytond-admin script')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    options = parser.parse_args(args)
+    if options.rows is None:
+        options.rows = ROWS[options.benchmark]
+
+    config.update_etc(options.config)
+    install_fake_padron()
+    Pool(options.database).init()
+    result = {
+        'benchmark': options.benchmark,
+        'rows': options.rows,
+        'backend': backend.name,
+        'version': get_version(options.database),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        **BENCHMARKS[options.benchmark](options),
+        }
+    print(json.dumps(result))
+    if options.output:
+        with open(options.output, 'a') as output:
+            output.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
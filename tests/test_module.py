@@ -1,13 +1,1150 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import urllib.error
+import zipfile
+from unittest.mock import patch
+
+from trytond.config import config as trytond_config
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.party.exceptions import InvalidIdentifierCode
+from trytond.modules.party_ar import afip_async
+from trytond.modules.party_ar.afip_async import (
+    SoapFault, httpx, parse_response,
+    query_padron_list as async_query_padron_list)
+from trytond.modules.party_ar.afip import (
+    CircuitBreaker, ClientPool, Padron, RateLimiter, afip_call,
+    circuit_breaker, is_transient_error, rate_limiter, read_padron_file,
+    ticket_expiration, ticket_fingerprint)
+from trytond.modules.party_ar.exceptions import (
+    AFIPUnavailable, PyAfipWsError)
+from trytond.modules.party_ar.validation import (
+    _check_digit, _check_digits_numpy, _numpy, check_cuits)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def fake_padron(**values):
+    "Return a Padron like the answers of WSSrPadronA5"
+    padron = {
+        'tipo_persona': 'JURIDICA',
+        'data': {'razonSocial': 'Empresa', 'estadoClave': 'ACTIVO'},
+        'monotributo': 'N',
+        'impuestos': [30, 10],
+        'actividades': [],
+        'domicilios': [],
+        'errores': [],
+        }
+    padron.update(values)
+    return Padron(**padron)
 
 
 class PartyArTestCase(CompanyTestMixin, ModuleTestCase):
     'Test party_ar module'
     module = 'party_ar'
 
+    def setUp(self):
+        super().setUp()
+        # The limiter and the breaker are shared by the process
+        self._afip_state = [(o, dict(vars(o)))
+            for o in [rate_limiter, circuit_breaker]]
+
+    def tearDown(self):
+        for obj, state in self._afip_state:
+            vars(obj).clear()
+            vars(obj).update(state)
+        super().tearDown()
+
+    @with_transaction()
+    def test_party_afip_sync_ttl(self):
+        "Test AFIP sync TTL grows while the padron is unchanged"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Configuration = pool.get('party.configuration')
+
+        config = Configuration(1)
+        config.census_ttl = dt.timedelta(days=10)
+        config.census_max_ttl = dt.timedelta(days=30)
+        config.save()
+        party = Party(name='Party')
+        party.save()
+        padron = fake_padron()
+        now = dt.datetime(2024, 1, 1)
+
+        party.set_afip_sync(padron, now=now)
+        self.assertEqual(party.afip_sync_unchanged, 0)
+        self.assertEqual(party.afip_sync_next, now + dt.timedelta(days=10))
+
+        party.set_afip_sync(padron, now=now)
+        self.assertEqual(party.afip_sync_unchanged, 1)
+        self.assertEqual(party.afip_sync_next, now + dt.timedelta(days=20))
+
+        party.set_afip_sync(padron, now=now)
+        self.assertEqual(party.afip_sync_next, now + dt.timedelta(days=30))
+
+        party.set_afip_sync(fake_padron(impuestos=[32]), now=now)
+        self.assertEqual(party.afip_sync_unchanged, 0)
+        self.assertEqual(party.afip_sync_next, now + dt.timedelta(days=10))
+
+    @with_transaction()
+    def test_set_padrons(self):
+        "Test set padrons updates many parties in bulk"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Country = pool.get('country.country')
+
+        Country(name='Argentina', code='AR').save()
+        party1, party2 = Party.create([{
+                    'name': 'Party 1',
+                    'addresses': [('create', [{'street': 'Old'}])],
+                    }, {
+                    'name': 'Party 2',
+                    'addresses': [('create', [{'street': 'Old'}])],
+                    }])
+        domicilio = {
+            'tipoDomicilio': 'FISCAL', 'direccion': 'Calle 1',
+            'localidad': 'La Plata', 'codPostal': '1900', 'idProvincia': 1}
+        Party.set_padrons([
+                (party1, fake_padron(
+                            domicilios=[domicilio])),
+                (party2, fake_padron(
+                            data={'razonSocial': 'Otra',
+                                'estadoClave': 'INACTIVO'},
+                            impuestos=[32])),
+                ])
+
+        party1, party2 = Party.browse([party1.id, party2.id])
+        self.assertEqual(party1.name, 'Empresa')
+        self.assertEqual(party1.iva_condition, 'responsable_inscripto')
+        self.assertEqual(party1.ganancias_condition, 'in')
+        self.assertEqual([a.street for a in party1.addresses], ['Calle 1'])
+        self.assertEqual(party2.name, 'Otra')
+        self.assertFalse(party2.active)
+        self.assertEqual(party2.iva_condition, 'exento')
+        self.assertEqual(party2.addresses, ())
+        self.assertEqual(Address.search([
+                    ('street', '=', 'Old'),
+                    ('active', '=', False),
+                    ], count=True), 2)
+
+    def setup_census(self):
+        "Create a company in homologacion and parties to census"
+        pool = Pool()
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with patch.object(Company, 'check_pyafipws_mode_cert'):
+            company.pyafipws_mode_cert = 'homologacion'
+            company.save()
+        Party.create([{
+                    'name': 'Party %s' % i,
+                    'iva_condition': 'consumidor_final',
+                    'identifiers': [('create', [{
+                                    'type': 'ar_vat',
+                                    'code': vat_number,
+                                    }])],
+                    } for i, vat_number in enumerate(
+                    ['20000000001', '20111111112', '30710158254'])])
+        return company
+
+    def census(self, company, query, tickets=None):
+        "Run the census with the fake query and access tickets"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Configuration = pool.get('party.configuration')
+
+        config = Configuration(1)
+        config.census_workers = 1
+        config.save()
+        tickets = iter(tickets or ['ticket'] * 10)
+
+        def credentials(company=None):
+            return {
+                'ta': next(tickets), 'mode': 'homologacion',
+                'cuit': '30710158254',
+                'wsdl': 'https://afip.test/personaServiceA5?wsdl',
+                }
+
+        if not trytond_config.has_section('party_ar'):
+            trytond_config.add_section('party_ar')
+        trytond_config.set('party_ar', 'afip_retry_delay', '0')
+        party_ar = 'trytond.modules.party_ar.party.'
+        try:
+            with set_company(company), \
+                    patch(party_ar + 'PADRON_LIST_LIMIT', 1), \
+                    patch(party_ar + 'query_padron_list', query), \
+                    patch.object(Party, 'get_ws_afip_credentials',
+                        credentials), \
+                    patch.object(Transaction(), 'commit'):
+                return Party.import_census(None)
+        finally:
+            trytond_config.remove_option('party_ar', 'afip_retry_delay')
+
+    @with_transaction()
+    def test_import_census(self):
+        "Test census updates the parties and renews the credentials"
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        Party = pool.get('party.party')
+        company = self.setup_census()
+        calls = []
+
+        def query(credentials, vat_numbers):
+            calls.append((credentials['ta'], list(vat_numbers)))
+            return {v: fake_padron()
+                for v in vat_numbers if v != '20111111112'}, {
+                '20111111112': 'No existe persona con ese Id'}
+
+        stats = self.census(company, query, tickets=['ticket1', 'ticket2'])
+        self.assertEqual(stats, {
+                'parties': 3, 'updated': 2, 'errors': 1, 'retries': 0,
+                'stopped': False,
+                })
+        self.assertEqual(calls, [
+                ('ticket1', ['20000000001']),
+                ('ticket1', ['20111111112']),
+                ('ticket2', ['30710158254']),
+                ])
+        self.assertEqual(Party.search([
+                    ('name', '=', 'Empresa'),
+                    ('afip_sync_next', '!=', None),
+                    ('iva_condition', '=', 'responsable_inscripto'),
+                    ], count=True), 2)
+        self.assertEqual(Party.search([
+                    ('vat_number', '=', '20111111112'),
+                    ('afip_sync_next', '=', None),
+                    ], count=True), 1)
+        self.assertEqual(
+            set(AFIPPadron.get_padrons(
+                    ['20000000001', '20111111112', '30710158254'],
+                    complete=True)),
+            {'20000000001', '30710158254'})
+
+    @with_transaction()
+    def test_import_census_retry(self):
+        "Test census retries the batches that failed transiently"
+        company = self.setup_census()
+        calls = []
+
+        def query(credentials, vat_numbers):
+            calls.append(list(vat_numbers))
+            if len(calls) == 1:
+                raise TimeoutError
+            return {v: fake_padron()
+                for v in vat_numbers}, {}
+
+        stats = self.census(company, query)
+        self.assertEqual(stats, {
+                'parties': 3, 'updated': 3, 'errors': 0, 'retries': 1,
+                'stopped': False,
+                })
+        self.assertEqual(calls[0], calls[2])
+
+    @with_transaction()
+    def test_import_census_unavailable(self):
+        "Test census stops early when AFIP is unavailable"
+        company = self.setup_census()
+        calls = []
+
+        def query(credentials, vat_numbers):
+            calls.append(list(vat_numbers))
+            raise AFIPUnavailable('unavailable')
+
+        stats = self.census(company, query)
+        self.assertEqual(stats, {
+                'parties': 3, 'updated': 0, 'errors': 0, 'retries': 0,
+                'stopped': True,
+                })
+        self.assertNotIn(['30710158254'], calls)
+
+    @with_transaction()
+    def test_import_census_asyncio(self):
+        "Test census with the asyncio client retries the failed batches"
+        pool = Pool()
+        Configuration = pool.get('party.configuration')
+        Party = pool.get('party.party')
+        company = self.setup_census()
+        config = Configuration(1)
+        config.census_asyncio = True
+        config.save()
+        persona_list = (
+            '<soap:Envelope '
+            'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soap:Body><ns2:getPersonaList_v2Response '
+            'xmlns:ns2="http://a5.soap.ws.server.puc.sr/">'
+            '<personaListReturn><persona><datosGenerales>'
+            '<idPersona>30710158254</idPersona>'
+            '<tipoPersona>JURIDICA</tipoPersona>'
+            '<razonSocial>Empresa</razonSocial>'
+            '<estadoClave>ACTIVO</estadoClave>'
+            '</datosGenerales></persona></personaListReturn>'
+            '</ns2:getPersonaList_v2Response></soap:Body></soap:Envelope>')
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            if len(calls) == 1:
+                return httpx.Response(503, text='<html>Unavailable</html>',
+                    headers={'Content-Type': 'text/html'})
+            return httpx.Response(200, text=persona_list,
+                headers={'Content-Type': 'text/xml'})
+        fetch_padrons = afip_async.fetch_padrons
+
+        def fetch(*args, **kwargs):
+            return fetch_padrons(*args, **kwargs,
+                transport=httpx.MockTransport(handler))
+
+        with patch.object(afip_async, 'fetch_padrons', fetch):
+            stats = self.census(company, None)
+        self.assertEqual(stats, {
+                'parties': 3, 'updated': 1, 'errors': 2, 'retries': 1,
+                'stopped': False,
+                })
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(Party.search([
+                    ('name', '=', 'Empresa'),
+                    ('afip_sync_next', '!=', None),
+                    ], count=True), 1)
+
+    @with_transaction()
+    def test_set_padron_address(self):
+        "Test set padron updates the fiscal address only on changes"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Country = pool.get('country.country')
+
+        Country(name='Argentina', code='AR').save()
+        party = Party(name='Party')
+        party.save()
+        domicilio = {
+            'tipoDomicilio': 'FISCAL', 'direccion': 'Calle 1',
+            'localidad': 'La Plata', 'codPostal': '1900', 'idProvincia': 1}
+
+        party.set_padron(fake_padron(
+                    domicilios=[domicilio]))
+        address, = Address.search([('party', '=', party.id)])
+
+        party.set_padron(fake_padron(
+                    domicilios=[dict(domicilio, direccion='CALLE  1 ',
+                            codPostal='B1900')]))
+        self.assertEqual(Address.search([
+                    ('party', '=', party.id),
+                    ('active', 'in', [True, False]),
+                    ]), [address])
+        self.assertEqual(address.street, 'Calle 1')
+        self.assertEqual(address.postal_code, 'B1900')
+
+        party.set_padron(fake_padron(
+                    domicilios=[dict(domicilio, direccion='Calle 2')]
+                    ))
+        new_address, = Address.search([('party', '=', party.id)])
+        self.assertNotEqual(new_address, address)
+        self.assertEqual(new_address.street, 'Calle 2')
+        self.assertFalse(Address(address.id).active)
+
+    @with_transaction()
+    def test_afip_activity(self):
+        "Test AFIP activities are loaded and set from the padron"
+        pool = Pool()
+        Party = pool.get('party.party')
+        AFIPActivity = pool.get('afip.activity')
+
+        activity, = AFIPActivity.search([('rec_name', '=', '011111')])
+        self.assertEqual(activity.rec_name, '011111 - Cultivo de arroz')
+        self.assertIn(activity,
+            AFIPActivity.search([('rec_name', 'ilike', '%arroz%')]))
+        self.assertGreater(AFIPActivity.search([], count=True), 900)
+
+        activity.name = 'Old name'
+        activity.save()
+        count = AFIPActivity.search([], count=True)
+        AFIPActivity.load_activities()
+        self.assertEqual(AFIPActivity.search([], count=True), count)
+        self.assertEqual(AFIPActivity(activity.id).name, 'Cultivo de arroz')
+
+        party = Party(name='Party')
+        party.save()
+        Party.write([party], party.get_padron_values(fake_padron(
+                        actividades=[11111, 999999])))
+        self.assertEqual(party.primary_activity, activity)
+        self.assertEqual(party.primary_activity_code, '011111')
+        self.assertIsNone(party.secondary_activity)
+        self.assertEqual(
+            Party.search([('primary_activity_code', '=', '011111')]),
+            [party])
+        self.assertEqual(
+            Party.search([('primary_activity_code', 'ilike', '01%')]),
+            [party])
+        self.assertEqual(
+            Party.search([('primary_activity_code', 'not ilike', '01%')]),
+            [])
+
+    @with_transaction()
+    def test_afip_activity_search(self):
+        "Test search of AFIP activities by code prefix and description"
+        pool = Pool()
+        AFIPActivity = pool.get('afip.activity')
+
+        activities = AFIPActivity.search([('rec_name', 'ilike', '0111%')])
+        self.assertTrue(activities)
+        self.assertTrue(all(a.code.startswith('0111') for a in activities))
+        self.assertIn('011119', [a.code for a in AFIPActivity.search([
+                        ('rec_name', 'ilike', '%cebada cervecera%'),
+                        ])])
+
+    @with_transaction()
+    def test_afip_geography(self):
+        "Test AFIP provinces are resolved by code and cached"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Country = pool.get('country.country')
+        Subdivision = pool.get('country.subdivision')
+
+        self.assertIsNone(Party.get_afip_country())
+        country = Country(name='Argentina', code='AR')
+        country.save()
+        subdivision = Subdivision(country=country, name='Córdoba',
+            code='AR-X', type='province')
+        subdivision.save()
+
+        self.assertEqual(Party.get_afip_country(), country)
+        self.assertEqual(Address.default_country(), country.id)
+        self.assertEqual(Party.get_afip_subdivision(3), subdivision)
+        self.assertIsNone(Party.get_afip_subdivision(1))
+
+        subdivision.code = 'AR-B'
+        subdivision.save()
+        self.assertIsNone(Party.get_afip_subdivision(3))
+        self.assertEqual(Party.get_afip_subdivision(1), subdivision)
+
+    @with_transaction()
+    def test_padron_cache(self):
+        "Test padron cache stores and expires answers"
+        pool = Pool()
+        PadronCache = pool.get('afip.padron.cache')
+        Configuration = pool.get('party.configuration')
+
+        padron = fake_padron(
+                data={'razonSocial': 'Empresa',
+                    'fechaInscripcion': dt.datetime(2010, 5, 1)})
+        PadronCache.set_padron('30710158254', 'homologacion', padron)
+        PadronCache.set_padron('30710158254', 'homologacion', padron)
+
+        cached = PadronCache.get_padron('30710158254', 'homologacion')
+        self.assertEqual(cached.to_dict(), padron.to_dict())
+        self.assertIsNone(
+            PadronCache.get_padron('30710158254', 'produccion'))
+        self.assertEqual(PadronCache.search([], count=True), 1)
+
+        PadronCache.set_padrons({
+                '30710158254': padron,
+                '20111111112': padron,
+                }, 'homologacion')
+        self.assertEqual(PadronCache.search([], count=True), 2)
+        self.assertEqual(set(PadronCache.get_padrons(
+                    ['30710158254', '20111111112'], 'homologacion')),
+            {'30710158254', '20111111112'})
+
+        config = Configuration(1)
+        config.padron_cache_ttl = dt.timedelta()
+        config.save()
+        self.assertIsNone(
+            PadronCache.get_padron('30710158254', 'homologacion'))
+
+    @with_transaction()
+    def test_get_vat_numbers(self):
+        "Test VAT numbers are read and searched for many parties"
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        party1, party2, party3 = Party.create([{
+                    'name': 'Party 1',
+                    'iva_condition': 'responsable_inscripto',
+                    'identifiers': [('create', [{
+                                    'type': 'ar_vat',
+                                    'code': '30710158254',
+                                    }])],
+                    }, {
+                    'name': 'Party 2',
+                    'iva_condition': 'consumidor_final',
+                    'identifiers': [('create', [{
+                                    'type': 'ar_dni',
+                                    'code': '12345678',
+                                    }])],
+                    }, {
+                    'name': 'Party 3',
+                    'identifiers': [('create', [{
+                                    'type': 'ar_foreign',
+                                    'code': 'B-123.456',
+                                    }])],
+                    }])
+        self.assertEqual(
+            [(p['vat_number'], p['vat_number_afip_foreign'])
+                for p in Party.read([party1.id, party2.id, party3.id],
+                    ['vat_number', 'vat_number_afip_foreign'])],
+            [('30710158254', None), ('12345678', None), (None, 'B-123.456')])
+
+        self.assertEqual(
+            Party.search([('vat_number', '=', '30-71015825-4')]), [party1])
+        self.assertEqual(
+            Party.search([('vat_number', 'in', ['12.345.678', 'x'])]),
+            [party2])
+        self.assertEqual(
+            Party.search([('vat_number_afip_foreign', '=', '30710158254')]),
+            [])
+        self.assertEqual(
+            Party.search([('vat_number_afip_foreign', '=', 'B-123.456')]),
+            [party3])
+
+    @with_transaction()
+    def test_set_vat_number(self):
+        "Test setting the VAT number on many parties"
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([
+                {'name': 'Party 1', 'vat_number': '20-00000000-1',
+                    'iva_condition': 'responsable_inscripto'},
+                {'name': 'Party 2', 'iva_condition': 'responsable_inscripto'},
+                ])
+        Party.write([party1, party2], {'vat_number': '30710158254'})
+        for party in [party1, party2]:
+            self.assertEqual(
+                [(i.type, i.code) for i in party.identifiers],
+                [('ar_vat', '30710158254')])
+
+        Party.write([party1, party2], {'vat_number': None})
+        self.assertEqual(party1.identifiers, ())
+        self.assertEqual(party2.identifiers, ())
+
+    @with_transaction()
+    def test_check_vat_number(self):
+        "Test the CUIT are checked by record and in bulk on validation"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+
+        with self.assertRaises(InvalidIdentifierCode):
+            Identifier(type='ar_vat', code='30710158255').check_code()
+        with patch('trytond.modules.party_ar.party.check_cuits',
+                side_effect=check_cuits) as check:
+            Party.create([{
+                        'name': 'Party',
+                        'iva_condition': 'responsable_inscripto',
+                        'identifiers': [('create', [{
+                                        'type': 'ar_vat',
+                                        'code': '30710158254',
+                                        }, {
+                                        'type': 'ar_vat',
+                                        'code': '20000000001',
+                                        }])],
+                        }])
+        check.assert_called_once_with(['30710158254', '20000000001'])
+
+    @with_transaction()
+    def test_check_foreign_vat(self):
+        "Test foreign VAT numbers are checked against the AFIP registry"
+        pool = Pool()
+        Party = pool.get('party.party')
+        AFIPCountry = pool.get('afip.country')
+        AFIPVatCountry = pool.get('party.afip.vat.country')
+
+        country = AFIPCountry(code='999', name='Country')
+        country.save()
+        vat_country = AFIPVatCountry(
+            vat_number='55000002126', afip_country=country, type_code='0')
+        vat_country.save()
+        vat_numbers = AFIPVatCountry.get_vat_numbers()
+        self.assertEqual(vat_numbers, {(country.id, '55000002126')})
+        self.assertEqual(AFIPVatCountry.get_vat_numbers(), vat_numbers)
+        party = Party(name='Party')
+        party.save()
+
+        def create_identifier(code):
+            return Party.write([party], {
+                    'identifiers': [('create', [{
+                                    'type': 'ar_foreign',
+                                    'code': code,
+                                    'afip_country': country.id,
+                                    }])],
+                    })
+
+        create_identifier('55000002126')
+        with self.assertRaises(InvalidIdentifierCode):
+            create_identifier('55000002127')
+
+        vat_country.vat_number = '55000002127'
+        vat_country.save()
+        self.assertEqual(AFIPVatCountry.get_vat_numbers(),
+            {(country.id, '55000002127')})
+        create_identifier('55000002127')
+
+    @with_transaction()
+    def test_import_padron_file(self):
+        "Test import of the contributor file of AFIP"
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        Party = pool.get('party.party')
+
+        party, = Party.create([{
+                    'name': 'Empresa',
+                    'iva_condition': 'consumidor_final',
+                    'identifiers': [('create', [{
+                                    'type': 'ar_vat',
+                                    'code': '30710158254',
+                                    }])],
+                    }])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'padron.zip')
+            with zipfile.ZipFile(path, 'w') as archive:
+                archive.writestr('utlfile/padr/padron.tmp', ''.join([
+                            '30710158254' + 'EMPRESA'.ljust(30)
+                            + 'ACAC' + 'NI' + 'NS' + '00\r\n',
+                            '20000000001' + 'PEÑA'.ljust(30)
+                            + 'NINI' + 'A ' + 'NN' + '01\r\n',
+                            ]).encode('latin-1'))
+
+            records = list(read_padron_file(path))
+            self.assertEqual(len(records), 2)
+            self.assertEqual(records[1]['denominacion'], 'PEÑA')
+            self.assertEqual(records[1]['monotributo'], 'A')
+
+            stats = Party.import_padron_file(path)
+        self.assertEqual(stats, {
+                'records': 2, 'matched': 1, 'updated': 1, 'mirrored': 2})
+        party = Party(party.id)
+        self.assertEqual(party.iva_condition, 'responsable_inscripto')
+        self.assertEqual(party.ganancias_condition, 'in')
+        self.assertEqual(
+            AFIPPadron.get_padron('20000000001').data['razonSocial'], 'PEÑA')
+
+    @with_transaction()
+    def test_padron_mirror(self):
+        "Test padron mirror rebuilds the padron"
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        Party = pool.get('party.party')
+
+        padron = fake_padron(
+                tipo_persona='FISICA',
+                data={
+                    'apellido': 'Pérez', 'nombre': 'Juan',
+                    'estadoClave': 'ACTIVO',
+                    'fechaInscripcion': dt.datetime(2010, 5, 1)},
+                impuestos=[20, 32, 11],
+                actividades=[620100, 11111],
+                domicilios=[{
+                        'tipoDomicilio': 'FISCAL', 'direccion': 'Calle 1',
+                        'localidad': 'La Plata', 'codPostal': '1900',
+                        'idProvincia': 1}])
+        AFIPPadron.set_padron('20000000001', padron)
+        AFIPPadron.set_padron('20000000001', padron)
+
+        mirrored = AFIPPadron.get_padron('20000000001', complete=True)
+        self.assertEqual(mirrored.data['apellido'], 'Pérez')
+        self.assertEqual(mirrored.data['fechaInscripcion'],
+            dt.datetime(2010, 5, 1))
+        self.assertEqual(mirrored.actividades, [620100, 11111])
+        self.assertEqual(mirrored.domicilios, padron.domicilios)
+        self.assertEqual(
+            Party.get_padron_conditions(
+                mirrored.impuestos, mirrored.monotributo),
+            ('exento', 'in'))
+        self.assertEqual(AFIPPadron.search([], count=True), 1)
+
+        party = Party()
+        party.vat_number = '20-00000000-1'
+        party.on_change_vat_number()
+        self.assertEqual(party.name, 'Pérez, Juan')
+        self.assertEqual(party.iva_condition, 'exento')
+
+    @with_transaction()
+    def test_padron_mirror_import_file(self):
+        "Test padron mirror filled from the contributor file"
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+
+        AFIPPadron.set_padron('30710158254', fake_padron(
+                    data={'razonSocial': 'Empresa WS',
+                        'estadoClave': 'ACTIVO'}))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'padron.zip')
+            with zipfile.ZipFile(path, 'w') as archive:
+                archive.writestr('utlfile/padr/padron.tmp', ''.join([
+                            '30710158254' + 'EMPRESA'.ljust(30)
+                            + 'ACAC' + 'NI' + 'NS' + '00\r\n',
+                            '20000000001' + 'PEÑA'.ljust(30)
+                            + 'NIEX' + 'NI' + 'NN' + '01\r\n',
+                            ]).encode('latin-1'))
+            self.assertEqual(AFIPPadron.import_file(path), 1)
+
+        padron = AFIPPadron.get_padron('20000000001')
+        self.assertEqual(padron.data['razonSocial'], 'PEÑA')
+        self.assertIsNone(padron.data['estadoClave'])
+        self.assertEqual(
+            AFIPPadron.values_from_padron(padron)['iva_condition'], 'exento')
+        self.assertIsNone(AFIPPadron.get_padron('20000000001', complete=True))
+        self.assertEqual(AFIPPadron.get_padron('30710158254').data[
+                'razonSocial'], 'Empresa WS')
+
+    @with_transaction()
+    def test_padron_purge_expired(self):
+        "Test purge of the expired padron cache and mirror entries"
+        pool = Pool()
+        AFIPPadron = pool.get('afip.padron')
+        PadronCache = pool.get('afip.padron.cache')
+        Configuration = pool.get('party.configuration')
+
+        padron = fake_padron()
+        AFIPPadron.set_padron('30710158254', padron)
+        PadronCache.set_padron('30710158254', 'homologacion', padron)
+        AFIPPadron.purge_expired()
+        PadronCache.purge_expired()
+        self.assertEqual(AFIPPadron.search([], count=True), 1)
+        self.assertEqual(PadronCache.search([], count=True), 1)
+
+        config = Configuration(1)
+        config.padron_cache_ttl = dt.timedelta()
+        config.padron_mirror_ttl = dt.timedelta()
+        config.save()
+        AFIPPadron.purge_expired()
+        PadronCache.purge_expired()
+        self.assertEqual(AFIPPadron.search([], count=True), 0)
+        self.assertEqual(PadronCache.search([], count=True), 0)
+
+    @with_transaction()
+    def test_get_afip_padron(self):
+        "Test AFIP padron is read from the mirror before querying AFIP"
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        padron = fake_padron()
+        with patch.object(Party, 'get_ws_afip',
+                return_value=padron) as get_ws_afip:
+            self.assertEqual(
+                Party.get_afip_padron('30710158254').to_dict()['data'][
+                    'razonSocial'], 'Empresa')
+            self.assertEqual(
+                Party.get_afip_padron('30710158254').to_dict()['data'][
+                    'razonSocial'], 'Empresa')
+        get_ws_afip.assert_called_once_with('30710158254', force=False)
+
+        padron = fake_padron(
+            data={'razonSocial': 'Empresa SA', 'estadoClave': 'ACTIVO'})
+        with patch.object(Party, 'get_ws_afip',
+                return_value=padron) as get_ws_afip:
+            self.assertEqual(
+                Party.get_afip_padron('30710158254', force=True).to_dict()[
+                    'data']['razonSocial'], 'Empresa SA')
+            self.assertEqual(
+                Party.get_afip_padron('30710158254').to_dict()['data'][
+                    'razonSocial'], 'Empresa SA')
+        get_ws_afip.assert_called_once_with('30710158254', force=True)
+
+    @with_transaction()
+    def test_get_afip_data_refresh(self):
+        "Test the AFIP data wizard refreshes the mirrored padron"
+        pool = Pool()
+        Party = pool.get('party.party')
+        GetAFIPData = pool.get('party.get_afip_data', type='wizard')
+
+        party = Party(name='Party', iva_condition='consumidor_final',
+            identifiers=[{'type': 'ar_vat', 'code': '30710158254'}])
+        party.save()
+        session_id, _, _ = GetAFIPData.create()
+        with Transaction().set_context(active_id=party.id), \
+                patch.object(Party, 'get_ws_afip') as get_ws_afip:
+            wizard = GetAFIPData(session_id)
+            get_ws_afip.return_value = fake_padron()
+            self.assertEqual(wizard.default_start(None)['name'], 'Empresa')
+
+            get_ws_afip.return_value = fake_padron(
+                data={'razonSocial': 'Empresa SA', 'estadoClave': 'ACTIVO'})
+            self.assertEqual(wizard.default_start(None)['name'], 'Empresa')
+            self.assertEqual(wizard.transition_refresh(), 'start')
+            self.assertEqual(wizard.default_start(None)['name'], 'Empresa SA')
+        self.assertEqual(get_ws_afip.call_count, 2)
+
+    @with_transaction()
+    def test_check_vat_numbers_wizard(self):
+        "Test the wizard reports the invalid CUIT of a file"
+        pool = Pool()
+        CheckVatNumbers = pool.get('party.check_vat_numbers', type='wizard')
+
+        session_id, _, _ = CheckVatNumbers.create()
+        wizard = CheckVatNumbers(session_id)
+        wizard.start.file_ = (
+            b'30-71015825-4;Empresa\n30710158255,Otra\n3071015825\n')
+        self.assertEqual(wizard.transition_check(), 'result')
+        self.assertEqual(wizard.default_result(None), {
+                'total': 3,
+                'invalid': 2,
+                'report': '2: 30710158255 (checksum)\n3: 3071015825 (length)',
+                })
+
+    def test_padron_from_persona(self):
+        "Test padron created from a persona of getPersonaList"
+        domicilio = {
+            'direccion': 'Calle 1', 'localidad': 'La Plata',
+            'codPostal': '1900', 'idProvincia': 1,
+            'tipoDomicilio': 'FISCAL'}
+        padron = Padron.from_persona({
+                'datosGenerales': {
+                    'idPersona': 30710158254,
+                    'tipoPersona': 'JURIDICA',
+                    'razonSocial': 'Empresa',
+                    'estadoClave': 'ACTIVO',
+                    'domicilioFiscal': domicilio,
+                    },
+                'datosRegimenGeneral': {
+                    'impuesto': [{'idImpuesto': 30}, {'idImpuesto': 10}],
+                    'actividad': [
+                        {'idActividad': 620900, 'orden': 2},
+                        {'idActividad': 620100, 'orden': 1},
+                        ],
+                    },
+                })
+        self.assertEqual(padron.tipo_persona, 'JURIDICA')
+        self.assertEqual(padron.data['razonSocial'], 'Empresa')
+        self.assertEqual(padron.monotributo, 'N')
+        self.assertEqual(padron.impuestos, [30, 10])
+        self.assertEqual(padron.actividades, [620100, 620900])
+        self.assertEqual(padron.domicilios, [domicilio])
+
+        padron = Padron.from_persona({
+                'errorConstancia': {
+                    'idPersona': 20000000001,
+                    'error': 'No existe persona con ese Id',
+                    },
+                })
+        self.assertEqual(padron.data, {})
+        self.assertEqual(
+            padron.errores, [{'error': 'No existe persona con ese Id'}])
+
+    def test_async_parse_response(self):
+        "Test parsing of the SOAP answers of the asyncio client"
+        content = (
+            '<soap:Envelope '
+            'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soap:Body><ns2:getPersona_v2Response '
+            'xmlns:ns2="http://a5.soap.ws.server.puc.sr/"><personaReturn>'
+            '<datosGenerales><idPersona>30710158254</idPersona>'
+            '<tipoPersona>JURIDICA</tipoPersona></datosGenerales>'
+            '<datosRegimenGeneral>'
+            '<impuesto><idImpuesto>30</idImpuesto></impuesto>'
+            '<impuesto><idImpuesto>10</idImpuesto></impuesto>'
+            '</datosRegimenGeneral>'
+            '</personaReturn></ns2:getPersona_v2Response>'
+            '</soap:Body></soap:Envelope>')
+        padron = Padron.from_persona(parse_response(content, 'personaReturn'))
+        self.assertEqual(padron.data['idPersona'], 30710158254)
+        self.assertEqual(padron.impuestos, [30, 10])
+
+        fault = (
+            '<soap:Envelope '
+            'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soap:Body><soap:Fault><faultcode>soap:Server</faultcode>'
+            '<faultstring>Error</faultstring></soap:Fault>'
+            '</soap:Body></soap:Envelope>')
+        with self.assertRaises(SoapFault):
+            parse_response(fault, 'personaReturn')
+
+    @unittest.skipIf(httpx is None, "httpx is not installed")
+    def test_async_client(self):
+        "Test the asyncio client against a mocked transport"
+        credentials = {
+            'ta': '<token>TOKEN</token><sign>SIGN</sign>',
+            'cuit': '30710158254',
+            'wsdl': 'https://afip.test/personaServiceA5?wsdl',
+            }
+        persona_list = (
+            '<soap:Envelope '
+            'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soap:Body><ns2:getPersonaList_v2Response '
+            'xmlns:ns2="http://a5.soap.ws.server.puc.sr/">'
+            '<personaListReturn><persona><datosGenerales>'
+            '<idPersona>30710158254</idPersona>'
+            '<tipoPersona>JURIDICA</tipoPersona>'
+            '<razonSocial>Empresa</razonSocial>'
+            '</datosGenerales></persona></personaListReturn>'
+            '</ns2:getPersonaList_v2Response></soap:Body></soap:Envelope>')
+        fault = (
+            '<soap:Envelope '
+            'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soap:Body><soap:Fault><faultcode>soap:Server</faultcode>'
+            '<faultstring>Error</faultstring></soap:Fault>'
+            '</soap:Body></soap:Envelope>')
+        responses = []
+
+        def handler(request):
+            self.assertEqual(
+                str(request.url), 'https://afip.test/personaServiceA5')
+            self.assertIn(b'<token>TOKEN</token>', request.content)
+            return responses.pop(0)
+
+        def query():
+            return async_query_padron_list(credentials,
+                ['30710158254', '20111111112'],
+                transport=httpx.MockTransport(handler))
+
+        bad_gateway = httpx.Response(502, text='<html>Bad</html>',
+            headers={'Content-Type': 'text/html'})
+
+        if not trytond_config.has_section('party_ar'):
+            trytond_config.add_section('party_ar')
+        trytond_config.set('party_ar', 'afip_retries', '1')
+        trytond_config.set('party_ar', 'afip_retry_delay', '0')
+        self.addCleanup(
+            trytond_config.remove_option, 'party_ar', 'afip_retries')
+        self.addCleanup(
+            trytond_config.remove_option, 'party_ar', 'afip_retry_delay')
+
+        responses.append(httpx.Response(200, text=persona_list,
+                headers={'Content-Type': 'text/xml'}))
+        padrons, errors = query()
+        self.assertEqual(padrons['30710158254'].data['razonSocial'],
+            'Empresa')
+        self.assertEqual(list(errors), ['20111111112'])
+
+        responses.append(httpx.Response(500, text=fault,
+                headers={'Content-Type': 'text/xml'}))
+        padrons, errors = query()
+        self.assertEqual(padrons, {})
+        self.assertEqual(errors, {
+                '30710158254': 'Error', '20111111112': 'Error'})
+        self.assertEqual(circuit_breaker.failures, 0)
+
+        responses.extend([bad_gateway, bad_gateway])
+        padrons, errors = query()
+        self.assertEqual(padrons, {})
+        self.assertIn('502', errors['30710158254'])
+        self.assertEqual(circuit_breaker.failures, 2)
+
+        responses.extend([bad_gateway, httpx.Response(200, text=persona_list,
+                    headers={'Content-Type': 'text/xml'})])
+        padrons, errors = query()
+        self.assertEqual(list(padrons), ['30710158254'])
+        self.assertEqual(circuit_breaker.failures, 0)
+        self.assertEqual(responses, [])
+
+    def test_ticket_expiration(self):
+        "Test expiration of the access ticket"
+        ta = ('<loginTicketResponse><header>'
+            '<expirationTime>2024-07-31T22:10:37.123-03:00</expirationTime>'
+            '</header></loginTicketResponse>')
+        self.assertEqual(ticket_expiration(ta), dt.datetime(
+                2024, 8, 1, 1, 10, 37, 123000, tzinfo=dt.timezone.utc))
+        self.assertIsNone(ticket_expiration('<loginTicketResponse/>'))
+
+    @with_transaction()
+    def test_authenticate_cached_ticket(self):
+        "Test authenticate uses the ticket of the process"
+        pool = Pool()
+        PyAfipWsWrapper = pool.get('afip.wrapper')
+
+        expiration = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=1)
+        key = ('wsfe', ticket_fingerprint('wsfe', 'crt', 'key'), 'wsdl')
+        PyAfipWsWrapper._tickets[key] = PyAfipWsWrapper._new_ticket(
+            'ticket', expiration)
+        try:
+            self.assertEqual(PyAfipWsWrapper.authenticate(
+                    'wsfe', 'crt', 'key', wsdl='wsdl'), 'ticket')
+        finally:
+            del PyAfipWsWrapper._tickets[key]
+
+    @with_transaction()
+    def test_authenticate_renewal_failure(self):
+        "Test authenticate keeps the valid ticket when renewal fails"
+        pool = Pool()
+        PyAfipWsWrapper = pool.get('afip.wrapper')
+
+        calls = []
+
+        def fail(*args, **kwargs):
+            calls.append(args)
+            raise PyAfipWsError('coe.alreadyAuthenticated')
+
+        def authenticate():
+            return PyAfipWsWrapper.authenticate(
+                'wsfe', 'crt', 'key', wsdl='wsdl')
+
+        now = dt.datetime.now(dt.timezone.utc)
+        key = ('wsfe', ticket_fingerprint('wsfe', 'crt', 'key'), 'wsdl')
+        try:
+            with patch.object(PyAfipWsWrapper, '_authenticate', fail):
+                PyAfipWsWrapper._tickets[key] = PyAfipWsWrapper._new_ticket(
+                    'ticket', now + dt.timedelta(minutes=5))
+                self.assertEqual(authenticate(), 'ticket')
+                self.assertEqual(authenticate(), 'ticket')
+                self.assertEqual(len(calls), 1)
+
+                # the renewal is tried again after the delay
+                PyAfipWsWrapper._tickets[key] = PyAfipWsWrapper._new_ticket(
+                    *PyAfipWsWrapper._tickets[key][:2])
+                self.assertEqual(authenticate(), 'ticket')
+                self.assertEqual(len(calls), 2)
+
+                PyAfipWsWrapper._tickets[key] = PyAfipWsWrapper._new_ticket(
+                    'ticket', now - dt.timedelta(minutes=5))
+                with self.assertRaises(PyAfipWsError):
+                    authenticate()
+        finally:
+            del PyAfipWsWrapper._tickets[key]
+
+    def test_client_pool(self):
+        "Test client pool reuses, recycles and invalidates clients"
+        pool = ClientPool()
+        clients = []
+
+        def connect():
+            clients.append(object())
+            return clients[-1]
+
+        with pool.client('a', connect) as client:
+            pass
+        with pool.client('a', connect) as other:
+            self.assertIs(other, client)
+        with pool.client('b', connect) as other:
+            self.assertIsNot(other, client)
+        with self.assertRaises(ValueError):
+            with pool.client('a', connect):
+                raise ValueError
+        with pool.client('a', connect) as client:
+            pass
+        self.assertEqual(len(clients), 3)
+
+        pool.invalidate(lambda key: key == 'a')
+        with pool.client('a', connect):
+            pass
+        with pool.client('b', connect):
+            pass
+        self.assertEqual(len(clients), 4)
+
+    def test_rate_limiter(self):
+        "Test rate limiter adapts its rate"
+        limiter = RateLimiter(
+            rate=10, min_rate=1, max_rate=11, target_latency=2, increase=1)
+        limiter.success(0.5)
+        self.assertEqual(limiter.rate, 11)
+        limiter.success(0.5)
+        self.assertEqual(limiter.rate, 11)
+        limiter.success(3)
+        self.assertAlmostEqual(limiter.rate, 9.9)
+        limiter.failure()
+        self.assertAlmostEqual(limiter.rate, 4.95)
+        for _ in range(10):
+            limiter.failure()
+        self.assertEqual(limiter.rate, 1)
+
+    def test_circuit_breaker(self):
+        "Test circuit breaker opens and probes after the cooldown"
+        breaker = CircuitBreaker(threshold=2, cooldown=0)
+        breaker.before()
+        breaker.failure()
+        breaker.before()
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        breaker.before()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        with self.assertRaises(AFIPUnavailable):
+            breaker.before()
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        breaker.before()
+        breaker.success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertFalse(is_transient_error(AFIPUnavailable('unavailable')))
+
+    def test_afip_call_breaker(self):
+        "Test only the transient failures trip the circuit breaker"
+        breaker = CircuitBreaker(threshold=1, cooldown=60)
+        with patch('trytond.modules.party_ar.afip.circuit_breaker', breaker):
+            with self.assertRaises(SoapFault):
+                with afip_call():
+                    raise SoapFault('soap:Server',
+                        'No existe persona con ese Id 20503287961')
+            self.assertEqual(breaker.state, breaker.CLOSED)
+            self.assertEqual(breaker.failures, 0)
+
+            with self.assertRaises(TimeoutError):
+                with afip_call():
+                    raise TimeoutError
+            self.assertEqual(breaker.state, breaker.OPEN)
+            with self.assertRaises(AFIPUnavailable):
+                with afip_call():
+                    pass
+
+    def test_check_cuits(self):
+        "Test validation of many CUIT at once"
+        self.assertEqual(check_cuits([
+                    '30-71015825-4', '30710158255', '3071015825',
+                    '99710158254', '3071015825A', '20000000001']), [
+                (1, '30710158255', 'checksum'),
+                (2, '3071015825', 'length'),
+                (3, '99710158254', 'component'),
+                (4, '3071015825A', 'format'),
+                ])
+
+    @unittest.skipIf(_numpy() is None, "numpy is not installed")
+    def test_check_cuits_numpy(self):
+        "Test the check digits computed with numpy"
+        numbers = ['30710158254', '30710158255', '20000000001',
+            '20111111112', '20111111113', '27222222220']
+        self.assertEqual(_check_digits_numpy(_numpy(), numbers),
+            [_check_digit(n) for n in numbers])
+        self.assertEqual(_check_digits_numpy(_numpy(), numbers),
+            [True, False, True, True, False, False])
+
+    def test_is_transient_error(self):
+        "Test detection of transient errors"
+        self.assertTrue(is_transient_error(TimeoutError()))
+        self.assertTrue(is_transient_error(ConnectionResetError()))
+        self.assertTrue(is_transient_error(urllib.error.URLError(
+                    TimeoutError('timed out'))))
+        self.assertTrue(is_transient_error(urllib.error.HTTPError(
+                    'https://afip.test', 503, 'Service Unavailable', {},
+                    None)))
+        self.assertFalse(is_transient_error(urllib.error.HTTPError(
+                    'https://afip.test', 404, 'Not Found', {}, None)))
+        self.assertFalse(is_transient_error(
+                SoapFault('soap:Server', 'Service Unavailable')))
+        self.assertFalse(is_transient_error(
+                Exception('HTTP Error 503: Service Unavailable')))
+        self.assertFalse(is_transient_error(
+                ValueError('No existe persona con ese Id 20504287961')))
+        with patch('trytond.modules.party_ar.afip.TRANSIENT_FAULTS',
+                {'Server.Busy'}):
+            self.assertTrue(is_transient_error(
+                    SoapFault('soap:Server.Busy', 'Error')))
+
+    def test_import_time(self):
+        "Test the heavy modules are not imported with the module"
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+                'import trytond.modules.party_ar'],
+            capture_output=True, text=True, check=True)
+        imported = {
+            line.rsplit('|', 1)[-1].strip()
+            for line in result.stderr.splitlines()
+            if line.startswith('import time:')}
+        for name in [
+                'pyafipws', 'numpy', 'httpx',
+                'trytond.modules.party_ar.actividades']:
+            self.assertNotIn(name, imported)
+
 
 del ModuleTestCase
@@ -0,0 +1,75 @@
+# This file is part of the party_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Validation of many CUIT at once.
+
+It follows the rules of stdnum.ar.cuit. The check digits are computed over a
+matrix of digits with numpy when it is installed.
+'''
+import functools
+
+from stdnum.util import clean
+
+CUIT_WEIGHTS = (5, 4, 3, 2, 7, 6, 5, 4, 3, 2)
+CUIT_PREFIXES = ('20', '23', '24', '27', '30', '33', '34', '50', '51', '55')
+# check digit by the remainder of the weighted sum
+CUIT_CHECK_DIGITS = '09987654321'
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    # numpy is imported on first use as it is slow to import
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def compact_cuit(code):
+    return clean(code or '', ' -./').strip()
+
+
+def check_cuits(codes):
+    '''
+    Return a list of (row, code, error) for the invalid CUIT of codes
+
+    The error is one of 'format', 'length', 'component' or 'checksum' like
+    the exceptions of stdnum.
+    '''
+    report, candidates = [], []
+    for row, code in enumerate(codes):
+        number = compact_cuit(code)
+        if not number.isdigit() or not number.isascii():
+            report.append((row, code, 'format'))
+        elif len(number) != 11:
+            report.append((row, code, 'length'))
+        elif number[:2] not in CUIT_PREFIXES:
+            report.append((row, code, 'component'))
+        else:
+            candidates.append((row, code, number))
+    numpy = _numpy()
+    if numpy is not None and candidates:
+        valid = _check_digits_numpy(numpy, [n for _, _, n in candidates])
+    else:
+        valid = [_check_digit(n) for _, _, n in candidates]
+    report.extend((row, code, 'checksum')
+        for (row, code, _), ok in zip(candidates, valid) if not ok)
+    report.sort()
+    return report
+
+
+def _check_digit(number):
+    total = sum(w * int(n) for w, n in zip(CUIT_WEIGHTS, number))
+    return number[-1] == CUIT_CHECK_DIGITS[total % 11]
+
+
+def _check_digits_numpy(numpy, numbers):
+    digits = numpy.frombuffer(
+        ''.join(numbers).encode('ascii'), dtype=numpy.uint8).reshape(
+        len(numbers), 11) - ord('0')
+    remainders = digits[:, :10].astype(numpy.int64) @ CUIT_WEIGHTS % 11
+    expected = numpy.frombuffer(
+        CUIT_CHECK_DIGITS.encode('ascii'), dtype=numpy.uint8) - ord('0')
+    return (expected[remainders] == digits[:, 10]).tolist()